@@ -53,7 +53,6 @@ class RegisterView(generics.CreateAPIView):
         try:
             serializer.is_valid(raise_exception=True)
             logger.debug("done with serialization")
-            print("done with serialization")
             user = serializer.save()
             logger.info("saved serialization")
             return Response({
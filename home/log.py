@@ -0,0 +1,110 @@
+# home/log.py
+"""
+Logging building blocks used by settings.LOGGING.
+
+- QueueHandler puts records on an in-memory queue. A background thread then
+  formats and writes them, so a log call never waits for stderr, in a request
+  thread or on the event loop. When the queue is full, records are dropped
+  and counted rather than blocking.
+- SamplingFilter keeps a fraction of the low-level records from chatty loggers.
+- TextFormatter and JSONFormatter redact bearer tokens and `token=` query
+  parameters from everything they write.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import re
+import sys
+import threading
+
+_SECRETS = re.compile(r'(?i)(\btoken=|\bBearer\s+)[^\s&"\']+')
+
+# LogRecord attributes that are not `extra` fields
+_RESERVED = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+
+def redact(text):
+    return _SECRETS.sub(r'\1[redacted]', text)
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, maxsize=10000, stream=None):
+        super().__init__(queue.Queue(maxsize))
+        self.target = logging.StreamHandler(stream or sys.stderr)
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+        self.listener = logging.handlers.QueueListener(self.queue, self.target)
+        self.listener.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Flush the queue and stop the listener thread."""
+        if self.listener._thread is not None:
+            self.listener.stop()
+
+    def setFormatter(self, fmt):
+        # Formatting happens on the listener thread
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        # Only resolve the message here, so later changes to the arguments
+        # don't show up in the log; everything else is formatted off-thread
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+
+
+class SamplingFilter(logging.Filter):
+    """Keep `rate` (0-1) of the records at or below `level`; higher levels always pass."""
+
+    def __init__(self, rate=1.0, level='INFO'):
+        super().__init__()
+        self.rate = float(rate)
+        self.level = level if isinstance(level, int) else logging.getLevelName(level.upper())
+
+    def filter(self, record):
+        return record.levelno > self.level or self.rate >= 1 or random.random() < self.rate
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        return redact(super().format(record))
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line, including any `extra` fields."""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, self.datefmt),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry['stack_info'] = self.formatStack(record.stack_info)
+        return redact(json.dumps(entry, default=str))
+
+
+def parse_levels(value):
+    """'messaging=DEBUG,django.db.backends=INFO' -> {'messaging': 'DEBUG', ...}"""
+    levels = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        name, _, level = item.partition('=')
+        levels[name.strip()] = level.strip().upper()
+    return levels
@@ -2,6 +2,11 @@ import os
 from pathlib import Path
 from datetime import timedelta
 
+from django.core.exceptions import ImproperlyConfigured
+
+from home.database import parse_database_url
+from home.log import parse_levels as parse_log_levels
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -39,6 +44,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'messaging.middleware.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     "corsheaders.middleware.CorsMiddleware",
@@ -74,29 +80,152 @@ ASGI_APPLICATION = "home.asgi.application"
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# Database calls from websocket consumers run one at a time on a single
+# thread per process. Set CHAT_DB_EXECUTOR_WORKERS to run them concurrently
+# on that many threads instead, each holding its own connection: size it to
+# the database connections one process may open (see DB_POOL_MAX_SIZE). Keep
+# it at 0 on SQLite, which takes one writer at a time.
+CHAT_DB_EXECUTOR_WORKERS = int(os.getenv("CHAT_DB_EXECUTOR_WORKERS", "0"))
+
+DATABASE_URL = os.getenv("DATABASE_URL", f"sqlite:///{BASE_DIR / 'db.sqlite3'}")
+DATABASES = {'default': parse_database_url(DATABASE_URL)}
+
+if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+    # WAL lets readers run alongside the writer. Transactions take the write
+    # lock up front, so concurrent writers wait for it (up to `timeout`
+    # seconds) instead of failing with "database is locked".
+    DATABASES['default']['OPTIONS'].update({
+        'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL',
+        'transaction_mode': 'IMMEDIATE',
+        'timeout': float(os.getenv("DB_TIMEOUT", "20")),
+    })
+elif os.getenv("DB_POOL", "True").lower() in ("1", "true", "yes"):
+    # psycopg's pool hands connections to requests and consumer threads.
+    # Every thread that talks to the database holds one while it works: the
+    # websocket DB threads (CHAT_DB_EXECUTOR_WORKERS, or the one shared
+    # thread) plus one per HTTP request in flight. Requests beyond
+    # DB_POOL_MAX_SIZE wait up to DB_POOL_TIMEOUT seconds for a connection.
+    DATABASES['default']['OPTIONS']['pool'] = {
+        'min_size': int(os.getenv("DB_POOL_MIN_SIZE", "2")),
+        'max_size': int(os.getenv("DB_POOL_MAX_SIZE", str(max(CHAT_DB_EXECUTOR_WORKERS, 1) + 10))),
+        'timeout': float(os.getenv("DB_POOL_TIMEOUT", "10")),
     }
-}
+else:
+    # Without the pool, keep connections open between requests instead
+    DATABASES['default']['CONN_MAX_AGE'] = int(os.getenv("DB_CONN_MAX_AGE", "60"))
+    DATABASES['default']['CONN_HEALTH_CHECKS'] = True
 
 # Redis and Channels Settings
 REDIS_URL = os.getenv("REDIS_URL", "redis://127.0.0.1:6379/1") 
 
-# CHANNEL_LAYERS = {
-#     "default": {
-#         "BACKEND": "channels_redis.core.RedisChannelLayer",
-#         "CONFIG": {
-#             "hosts": [REDIS_URL], 
-#         },
-#     },
-# }
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer",  # Change to Redis in production
-    },
-}
+# "memory" only works with a single worker process. Use "redis" (or
+# "redis_pubsub") whenever more than one Daphne worker serves websockets, so
+# that user_{id} groups are shared between processes and nodes.
+CHANNEL_LAYER_BACKEND = os.getenv("CHANNEL_LAYER_BACKEND", "memory")
+
+if CHANNEL_LAYER_BACKEND == "redis":
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "CONFIG": {
+                "hosts": [REDIS_URL],
+                "capacity": int(os.getenv("CHANNEL_LAYER_CAPACITY", "1000")),
+                "expiry": int(os.getenv("CHANNEL_LAYER_EXPIRY", "60")),
+            },
+        },
+    }
+elif CHANNEL_LAYER_BACKEND == "redis_pubsub":
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.pubsub.RedisPubSubChannelLayer",
+            "CONFIG": {
+                "hosts": [REDIS_URL],
+            },
+        },
+    }
+elif CHANNEL_LAYER_BACKEND == "memory":
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer",
+        },
+    }
+else:
+    raise ImproperlyConfigured(
+        f"Unknown CHANNEL_LAYER_BACKEND {CHANNEL_LAYER_BACKEND!r}; "
+        "expected 'memory', 'redis' or 'redis_pubsub'"
+    )
+
+# Presence: how many user_status sends run concurrently during fan-out, and
+# how long a disconnected user stays "online" so that a quick reconnect
+# (tab reload, flaky mobile network) produces no transition at all.
+PRESENCE_FANOUT_BATCH_SIZE = int(os.getenv("PRESENCE_FANOUT_BATCH_SIZE", "100"))
+PRESENCE_GRACE_SECONDS = float(os.getenv("PRESENCE_GRACE_SECONDS", "5"))
+# UserStatus is written in batches every PRESENCE_FLUSH_INTERVAL seconds (0
+# writes through immediately). Connections that send no "heartbeat" frame for
+# PRESENCE_CONNECTION_TTL seconds are dropped; 0 disables the check for
+# clients that do not heartbeat.
+PRESENCE_FLUSH_INTERVAL = float(os.getenv("PRESENCE_FLUSH_INTERVAL", "5"))
+PRESENCE_CONNECTION_TTL = float(os.getenv("PRESENCE_CONNECTION_TTL", "0"))
+# Where connection counts live: "memory" (this process only) or "redis"
+# (REDIS_URL, shared by all workers). Workers renew their connections every
+# PRESENCE_LEASE_SECONDS / 3; those of a crashed worker lapse after
+# PRESENCE_LEASE_SECONDS.
+PRESENCE_STORE = os.getenv("PRESENCE_STORE", "memory" if CHANNEL_LAYER_BACKEND == "memory" else "redis")
+PRESENCE_LEASE_SECONDS = float(os.getenv("PRESENCE_LEASE_SECONDS", "60"))
+if PRESENCE_STORE not in ("memory", "redis"):
+    raise ImproperlyConfigured(f"Unknown PRESENCE_STORE {PRESENCE_STORE!r}; expected 'memory' or 'redis'")
+
+# Websocket auth builds the scope user from JWT claims; full user records are
+# cached per process for WS_USER_CACHE_TTL seconds, at most WS_USER_CACHE_SIZE.
+WS_USER_CACHE_SIZE = int(os.getenv("WS_USER_CACHE_SIZE", "10000"))
+WS_USER_CACHE_TTL = float(os.getenv("WS_USER_CACHE_TTL", "300"))
+
+# Write-behind chat ingestion: when enabled, ChatConsumer assigns the message
+# id and timestamp, delivers immediately, and persists in micro-batches of up
+# to CHAT_INGEST_BATCH_SIZE collected over CHAT_INGEST_FLUSH_INTERVAL seconds,
+# acking each message to its sender once committed.
+CHAT_WRITE_BEHIND = os.getenv("CHAT_WRITE_BEHIND", "False").lower() in ("1", "true", "yes")
+CHAT_INGEST_BATCH_SIZE = int(os.getenv("CHAT_INGEST_BATCH_SIZE", "200"))
+CHAT_INGEST_FLUSH_INTERVAL = float(os.getenv("CHAT_INGEST_FLUSH_INTERVAL", "0.01"))
+CHAT_INGEST_QUEUE_SIZE = int(os.getenv("CHAT_INGEST_QUEUE_SIZE", "10000"))
+
+# Ephemeral events (typing) are forwarded only when their state changes, at
+# most once per CHAT_EPHEMERAL_INTERVAL seconds per conversation; typing
+# stops on its own after CHAT_TYPING_TIMEOUT seconds without a typing frame.
+CHAT_EPHEMERAL_INTERVAL = float(os.getenv("CHAT_EPHEMERAL_INTERVAL", "1"))
+CHAT_TYPING_TIMEOUT = float(os.getenv("CHAT_TYPING_TIMEOUT", "5"))
+
+# Frames to a websocket are queued and sent by a background task, waiting
+# CHAT_SEND_BATCH_WINDOW seconds to collect a burst (clients connecting with
+# ?batch=1 get it as one array frame). On servers whose ASGI send() waits
+# for the socket to drain, a client that falls CHAT_SEND_QUEUE_SIZE frames
+# behind loses its queued typing frames first, then its connection (close
+# code 4008). Daphne's send() never waits, so there the limit is not reached
+# (see messaging.outbox.Outbox).
+CHAT_SEND_BATCH_WINDOW = float(os.getenv("CHAT_SEND_BATCH_WINDOW", "0"))
+CHAT_SEND_QUEUE_SIZE = int(os.getenv("CHAT_SEND_QUEUE_SIZE", "256"))
+
+# Delta sync (messages/sync/) re-reads this many seconds of changes before a
+# settled cursor, to pick up writes that committed after a later one was read.
+CHAT_SYNC_OVERLAP_SECONDS = float(os.getenv("CHAT_SYNC_OVERLAP_SECONDS", "5"))
+
+# Worker number (0-31) embedded in generated message ids. Every process that
+# writes messages needs its own value; processes sharing one would generate
+# the same ids. Unset, the database assigns ids. Required by
+# CHAT_WRITE_BEHIND. Once ids are generated, keep it set: on PostgreSQL the id
+# sequence would otherwise hand out ids that sort before the generated ones.
+MESSAGE_ID_WORKER = os.getenv("MESSAGE_ID_WORKER") or None
+
+if CHAT_WRITE_BEHIND and MESSAGE_ID_WORKER is None:
+    raise ImproperlyConfigured("CHAT_WRITE_BEHIND needs MESSAGE_ID_WORKER, unique per worker process")
+
+# Send the Server-Timing header (query count and DB/serialization time) on
+# REST responses outside DEBUG too.
+SERVER_TIMING_HEADER = os.getenv("SERVER_TIMING_HEADER", "False").lower() in ("1", "true", "yes")
+
+# Bearer token for the Prometheus endpoint at /metrics and the details of
+# /health. When empty, only staff sessions (or DEBUG) can read them.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
 
 # REST Framework Settings (JWT Authentication)
 REST_FRAMEWORK = {
@@ -106,6 +235,10 @@ REST_FRAMEWORK = {
     "DEFAULT_PERMISSION_CLASSES": [
         "rest_framework.permissions.IsAuthenticated",
     ],
+    "DEFAULT_RENDERER_CLASSES": [
+        "messaging.renderers.FastJSONRenderer",
+        "rest_framework.renderers.BrowsableAPIRenderer",
+    ],
 }
 
 AUTHENTICATION_BACKENDS = (
@@ -247,17 +380,42 @@ SOCIAL_AUTH_GOOGLE_OAUTH2_SCOPE = ['email', 'profile']
 SOCIAL_AUTH_GOOGLE_OAUTH2_EXTRA_DATA = ['first_name', 'last_name'] 
 
 
+# Records are written by a background thread (home.log.QueueHandler).
+# LOG_FORMAT is "text" or "json"; LOG_LEVELS sets per-module levels, e.g.
+# "messaging=DEBUG,django.db.backends=INFO"; LOG_SAMPLE_RATE keeps that share
+# of INFO-and-below records.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
+    'formatters': {
+        'text': {
+            '()': 'home.log.TextFormatter',
+            'format': '%(asctime)s %(levelname)s %(name)s %(message)s',
+        },
+        'json': {
+            '()': 'home.log.JSONFormatter',
+        },
+    },
+    'filters': {
+        'sampling': {
+            '()': 'home.log.SamplingFilter',
+            'rate': float(os.getenv("LOG_SAMPLE_RATE", "1")),
+            'level': 'INFO',
+        },
+    },
     'handlers': {
         'console': {
-            'class': 'logging.StreamHandler',
+            '()': 'home.log.QueueHandler',
+            'maxsize': int(os.getenv("LOG_QUEUE_SIZE", "10000")),
+            'formatter': os.getenv("LOG_FORMAT", "text"),
+            'filters': ['sampling'],
         },
     },
     'root': {
         'handlers': ['console'],
-        'level': 'INFO',
+        'level': LOG_LEVEL,
     },
     'loggers': {
         'django.channels': {
@@ -265,5 +423,9 @@ LOGGING = {
             'level': 'DEBUG',
             'propagate': True,
         },
+        **{
+            name: {'level': level}
+            for name, level in parse_log_levels(os.getenv("LOG_LEVELS", "")).items()
+        },
     },
 }
\ No newline at end of file
@@ -7,6 +7,7 @@ from drf_yasg import openapi
 
 from django.conf import settings
 from django.conf.urls.static import static
+from messaging.views import health_view, metrics_view
 
 schema_view = get_schema_view(
     openapi.Info(
@@ -39,6 +40,8 @@ urlpatterns = [
     path("api/auth/", include("accounts.urls")),
     path('api/google/', include('social_django.urls', namespace='social')),
     path("api/messaging/", include("messaging.urls")),
+    path("metrics", metrics_view, name="metrics"),
+    path("health", health_view, name="health"),
 
     path("docs/", schema_view.with_ui("swagger", cache_timeout=0), name="swagger-ui"),
     path("redoc/", schema_view.with_ui("redoc", cache_timeout=0), name="redoc-ui"),
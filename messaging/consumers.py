@@ -1,11 +1,17 @@
 # messaging/consumers.py
-import json
+import asyncio
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from .models import Message, Contact, UserStatus
+from .db import database_sync_to_async
+from .ids import next_message_id
+from .models import Message, Contact, conversation_key_for
+from . import ingest, instrumentation, metrics, presence, wire
+from .ephemeral import EphemeralCoalescer
+from .outbox import Outbox
+from .middleware import TokenUser
 from django.utils.timezone import now
-from django.db.models import Q
+from django.db import transaction
 from urllib.parse import parse_qs
 
 User = get_user_model()
@@ -14,8 +20,25 @@ import logging
 logger = logging.getLogger(__name__)
 
 class ChatConsumer(AsyncWebsocketConsumer):
+    # Close code for a client too slow to keep up with its frames (only on
+    # servers whose send() waits for the socket; see Outbox)
+    OVERFLOW_CLOSE_CODE = 4008
+    # Close code for a connection that stopped sending heartbeats
+    STALE_CLOSE_CODE = 4009
+
+    # Maximum SQL queries per frame type (see messaging.instrumentation)
+    query_budgets = {
+        'message': 3,
+        'edit': 2,
+        'typing': 1,
+        'read': 2,
+        'heartbeat': 0,
+        'subscribe': 1,
+        'unsubscribe': 0,
+    }
+
     async def connect(self):
-        logger.info("Attempting WebSocket connection...")
+        logger.debug("Attempting WebSocket connection...")
         self.user = self.scope["user"]
         
         if not self.user.is_authenticated:
@@ -23,46 +46,89 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.close()
             return
 
+        # One connection carries every conversation of the user: all events
+        # arrive through the user group, and the client tells us which
+        # conversations are open with subscribe/unsubscribe frames
+        self.user_group = f"user_{self.user.id}"
+        self.subscriptions = set()
         query_params = parse_qs(self.scope["query_string"].decode())
-        self.contact_id = query_params.get("contact_id", [None])[0]
-
-        if not self.contact_id:
-            logger.error("Missing contact_id in WebSocket request, closing connection")
-            await self.close()
-            return
+        # JSON unless the client asked for a binary subprotocol
+        self.codec, subprotocol = wire.negotiate(self.scope.get('subprotocols', []))
+        # Clients that can take several events in one frame opt in with ?batch=1
+        self.batch = query_params.get("batch") == ["1"]
+        self.outbox = Outbox(self.send_frames, settings.CHAT_SEND_BATCH_WINDOW, settings.CHAT_SEND_QUEUE_SIZE)
+        self.ephemeral = EphemeralCoalescer(
+            self.send_ephemeral, settings.CHAT_EPHEMERAL_INTERVAL, settings.CHAT_TYPING_TIMEOUT
+        )
+        await metrics.observe_layer('group_add', self.channel_layer.group_add(self.user_group, self.channel_name))
 
-        self.user_group = f"user_{self.user.id}"
-        self.room_group_name = f"chat_{self.contact_id}"
+        # Contacts are loaded once and reused for every presence fan-out
+        self.contact_ids = set(await self.get_user_contacts())
 
-        # Join user-specific & chat-specific groups
-        await self.channel_layer.group_add(self.user_group, self.channel_name)
-        await self.channel_layer.group_add(self.room_group_name, self.channel_name)
+        # Older clients open one socket per conversation with ?contact_id=
+        contact_id = self.parse_contact_id(query_params.get("contact_id", [None])[0])
+        if contact_id in self.contact_ids:
+            self.subscriptions.add(contact_id)
 
-        # Mark user as online
-        await self.set_user_online(True)
-        await self.notify_status_change(True)
+        # Mark user as online on their first connection, unless this is a
+        # reconnect within the grace window, in which case contacts never saw
+        # the user go offline
+        first = await presence.registry.connect(
+            self.user.id, self.channel_name, on_lost=self.go_offline, close=self.close_stale
+        )
+        if first and not presence.cancel_offline(self.user.id):
+            await presence.registry.set_online(self.user.id, True)
+            await self.notify_status_change(True)
 
-        logger.info("WebSocket connection accepted")
-        await self.accept()
+        logger.info("WebSocket connection accepted for user %s", self.user.id)
+        metrics.websocket_connections.inc()
+        await self.accept(subprotocol)
 
     async def disconnect(self, close_code):
-        logger.info(f"Disconnecting with code: {close_code}")
+        logger.info("Disconnecting with code: %s", close_code)
         if hasattr(self, 'user_group'):
+            # Contacts must not be left looking at a typing indicator
+            await self.ephemeral.close()
+            self.outbox.close()
+
             # Leave user's group
-            await self.channel_layer.group_discard(
+            await metrics.observe_layer('group_discard', self.channel_layer.group_discard(
                 self.user_group,
                 self.channel_name
-            )
+            ))
+            metrics.websocket_connections.dec()
             
-            # Set user as offline
-            await self.set_user_online(False)
-            await self.notify_status_change(False)
-            logger.info("Cleanup completed")
-
-    async def receive(self, text_data):
-        data = json.loads(text_data)
-        message_type = data.get('type', 'message')
-
+            # Once the last connection is gone, set user as offline after the
+            # grace window passes without a reconnect
+            if await presence.registry.disconnect(self.user.id, self.channel_name):
+                await presence.schedule_offline(self.user.id, self.go_offline)
+            logger.debug("Cleanup completed")
+
+    async def close_stale(self):
+        logger.info("Closing connection of user %s after missed heartbeats", self.user.id)
+        await self.close(code=self.STALE_CLOSE_CODE)
+
+    async def go_offline(self):
+        if await presence.registry.is_online(self.user.id):
+            return
+        await presence.registry.set_online(self.user.id, False)
+        await self.notify_status_change(False)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        with instrumentation.measure() as timings:
+            with instrumentation.serializing():
+                data = wire.decode(text_data, bytes_data)
+            message_type = data.get('type', 'message')
+            await self.handle_frame(message_type, data)
+
+        frame_type = message_type if message_type in self.query_budgets else 'other'
+        metrics.frames_received.labels(frame_type).inc()
+        metrics.frame_seconds.labels(frame_type).observe(timings.total)
+        if frame_type != 'other':
+            timings.endpoint = f"{type(self).__name__}.{frame_type}"
+            instrumentation.finish(timings, self.query_budgets[frame_type])
+
+    async def handle_frame(self, message_type, data):
         if message_type == 'message':
             await self.handle_message(data)
         elif message_type == 'edit':
@@ -71,6 +137,54 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.handle_typing(data)
         elif message_type == 'read':
             await self.handle_read_status(data)
+        elif message_type == 'heartbeat':
+            presence.registry.heartbeat(self.user.id, self.channel_name)
+        elif message_type == 'subscribe':
+            await self.handle_subscribe(data)
+        elif message_type == 'unsubscribe':
+            await self.handle_unsubscribe(data)
+
+    @staticmethod
+    def parse_contact_id(value):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+
+    async def is_contact(self, contact_id):
+        if contact_id is not None and contact_id not in self.contact_ids:
+            # The contact may have been added after this socket connected
+            self.contact_ids = set(await self.get_user_contacts())
+        return contact_id in self.contact_ids
+
+    async def handle_subscribe(self, data):
+        contact_id = self.parse_contact_id(data.get('contact_id'))
+        if not await self.is_contact(contact_id):
+            await self.send_frame({
+                'type': 'error',
+                'message': 'Unknown contact'
+            })
+            return
+
+        self.subscriptions.add(contact_id)
+        await self.send_frame({
+            'type': 'subscribed',
+            'contact_id': contact_id
+        })
+
+    async def handle_unsubscribe(self, data):
+        contact_id = self.parse_contact_id(data.get('contact_id'))
+        self.subscriptions.discard(contact_id)
+        await self.send_frame({
+            'type': 'unsubscribed',
+            'contact_id': contact_id
+        })
+
+    async def get_user_record(self):
+        """Full User for this connection, loaded lazily for token-authenticated sockets."""
+        if isinstance(self.user, TokenUser):
+            return await self.user.aload()
+        return self.user
 
     async def handle_message(self, data):
         try:
@@ -83,19 +197,29 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 logger.warning("Missing receiver_id or content in message")
                 return
 
-            # Save message to database
-            message = await self.save_message(
-                receiver_id=receiver_id,
-                content=content,
-                is_image=is_image,
-                image_url=image_url
-            )
+            if settings.CHAT_WRITE_BEHIND:
+                # Deliver now, persist in the next batch and ack afterwards
+                receiver_id = self.parse_contact_id(receiver_id)
+                if not await self.is_contact(receiver_id):
+                    raise ValueError(f"User {self.user.id} has no contact {receiver_id}")
+                message = await self.queue_message(
+                    receiver_id=receiver_id,
+                    content=content,
+                    is_image=is_image,
+                    image_url=image_url
+                )
+            else:
+                # Save message and update both contacts in one transaction
+                message = await self.save_message(
+                    receiver_id=receiver_id,
+                    content=content,
+                    is_image=is_image,
+                    image_url=image_url
+                )
 
             # Get avatar URL instead of ImageFieldFile
-            avatar_url = self.user.avatar.url if self.user.avatar else None
-
-            # Update last message for contacts
-            await self.update_last_message(message)
+            user = await self.get_user_record()
+            avatar_url = user.avatar.url if user.avatar else None
 
             message_data = {
                 'type': 'chat_message',
@@ -103,173 +227,220 @@ class ChatConsumer(AsyncWebsocketConsumer):
                     'id': str(message.id),
                     'content': message.content,
                     'senderId': str(self.user.id),
-                    'senderName': self.user.username,
+                    'senderName': user.username,
                     'senderAvatar': avatar_url,  # Use URL instead of ImageFieldFile
                     'isImage': message.is_image,
-                    'imageUrl': message.image_url.url if message.image_url else None,  # Get URL if exists
+                    'imageUrl': message.image_url or None,
                     'timestamp': message.created_at.isoformat(),
                     'isRead': False
                 }
             }
 
-            # Send to receiver's group
-            await self.channel_layer.group_send(
-                f"user_{receiver_id}",
-                message_data
-            )
-
-            # Send back to sender's group
-            await self.channel_layer.group_send(
-                self.user_group,
-                message_data
+            # Send to receiver's group and back to sender's group
+            await asyncio.gather(
+                self.group_send(f"user_{receiver_id}", message_data),
+                self.group_send(self.user_group, message_data),
             )
         except Exception as e:
-            logger.error(f"Error handling message: {str(e)}")
-            await self.send(text_data=json.dumps({
+            logger.error("Error handling message: %s", e)
+            await self.send_frame({
                 'type': 'error',
                 'message': 'Failed to send message'
-            }))
+            })
 
     async def handle_edit_message(self, data):
         message_id = data.get('message_id')
         new_content = data.get('content')
 
         message = await self.edit_message(message_id, new_content)
-        if message:
-            edit_data = {
-                'type': 'message_edited',
-                'message': {
-                    'id': message.id,
-                    'content': message.content,
-                    'edited_at': message.edited_at.isoformat()
-                }
+        if message is None:
+            # Not the sender's message, or (with CHAT_WRITE_BEHIND) not stored
+            # yet; the client may retry once it has the message_ack
+            await self.send_frame({
+                'type': 'error',
+                'message': 'Failed to edit message',
+                'id': str(message_id)
+            })
+            return
+
+        edit_data = {
+            'type': 'message_edited',
+            'message': {
+                'id': message.id,
+                'content': message.content,
+                'edited_at': message.edited_at.isoformat()
             }
+        }
 
-            # Notify both sender and receiver
-            await self.channel_layer.group_send(
-                self.user_group,
-                edit_data
-            )
-            await self.channel_layer.group_send(
-                f"user_{message.receiver.id}",
-                edit_data
-            )
+        # Notify both sender and receiver
+        await self.group_send(
+            self.user_group,
+            edit_data
+        )
+        await self.group_send(
+            f"user_{message.receiver_id}",
+            edit_data
+        )
 
     async def handle_typing(self, data):
-        receiver_id = data.get('receiver')
-        is_typing = data.get('is_typing', False)
+        receiver_id = self.parse_contact_id(data.get('receiver'))
+        is_typing = bool(data.get('is_typing', False))
 
         if receiver_id:
-            await self.channel_layer.group_send(
+            # Keystroke-rate frames collapse into typing started/stopped
+            await self.ephemeral.update(('typing', receiver_id), is_typing, idle=False)
+
+    async def send_ephemeral(self, key, value):
+        kind, receiver_id = key
+        if kind == 'typing':
+            await self.group_send(
                 f"user_{receiver_id}",
                 {
                     'type': 'typing_status',
                     'user_id': self.user.id,
-                    'is_typing': is_typing
+                    'is_typing': value
                 }
             )
 
     async def handle_read_status(self, data):
-        sender_id = data.get('sender')
-        if sender_id:
-            await self.mark_messages_read(sender_id)
-            await self.channel_layer.group_send(
+        sender_id = self.parse_contact_id(data.get('sender'))
+        up_to = data.get('message_id')
+        if sender_id is None or (up_to is not None and self.parse_contact_id(up_to) is None):
+            return
+        watermark = await self.mark_messages_read(sender_id, up_to)
+        if watermark is not None:
+            await self.group_send(
                 f"user_{sender_id}",
                 {
                     'type': 'messages_read',
-                    'reader_id': self.user.id
+                    'reader_id': self.user.id,
+                    'last_read_message_id': watermark
                 }
             )
 
+    async def group_send(self, group, message):
+        await metrics.observe_layer('group_send', self.channel_layer.group_send(group, message))
+
+    async def send_frame(self, payload, key=None, droppable=False):
+        """Queue a frame for this client; see Outbox for `key` and `droppable`."""
+        if not self.outbox.put(payload, key, droppable):
+            logger.warning("Outbound queue of user %s overflowed, closing the connection", self.user.id)
+            await self.close(code=self.OVERFLOW_CLOSE_CODE)
+
+    async def send_frames(self, payloads):
+        for payload in payloads:
+            metrics.frames_sent.labels(payload.get('type', 'message')).inc()
+        # A batch goes out as one array frame
+        frames = [payloads] if self.batch and len(payloads) > 1 else payloads
+        for frame in frames:
+            data = self.codec.encode(frame)
+            metrics.bytes_sent.labels(self.codec.subprotocol).inc(len(data))
+            if self.codec.binary:
+                await self.send(bytes_data=data)
+            else:
+                await self.send(text_data=data)
+
     # Message handlers
     async def chat_message(self, event):
-        await self.send(text_data=json.dumps(event['message']))
+        await self.send_frame(event['message'])
 
     async def message_edited(self, event):
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             'type': 'message_edited',
             'message': event['message']
-        }))
+        }, key=('message_edited', event['message']['id']))
 
     async def typing_status(self, event):
-        await self.send(text_data=json.dumps({
+        # Typing indicators only matter for conversations the client has open
+        if event['user_id'] not in self.subscriptions:
+            return
+        await self.send_frame({
             'type': 'typing',
             'user_id': event['user_id'],
             'is_typing': event['is_typing']
-        }))
+        }, key=('typing', event['user_id']), droppable=True)
 
     async def messages_read(self, event):
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             'type': 'read_status',
-            'reader_id': event['reader_id']
-        }))
+            'reader_id': event['reader_id'],
+            'last_read_message_id': str(event['last_read_message_id'])
+        }, key=('read_status', event['reader_id']))
+
+    async def message_ack(self, event):
+        await self.send_frame({
+            'type': 'message_ack',
+            'id': str(event['message_id'])
+        })
+
+    async def message_failed(self, event):
+        await self.send_frame({
+            'type': 'message_failed',
+            'id': str(event['message_id'])
+        })
 
     # Database operations
-    @database_sync_to_async
-    def save_message(self, receiver_id, content, is_image=False, image_url=None):
-        return Message.objects.create(
-            sender=self.user,
+    async def queue_message(self, receiver_id, content, is_image=False, image_url=None):
+        """Build the message with its final id and timestamp and hand the INSERT to the writer."""
+        message = Message(
+            id=next_message_id(),
+            sender_id=self.user.id,
             receiver_id=receiver_id,
             content=content,
             is_image=is_image,
-            image_url=image_url
+            image_url=image_url,
+            conversation_key=conversation_key_for(self.user.id, receiver_id)
         )
+        await ingest.writer.submit(message, self.channel_name)
+        return message
+
+    @database_sync_to_async
+    def save_message(self, receiver_id, content, is_image=False, image_url=None):
+        with transaction.atomic():
+            message = Message.objects.create(
+                sender_id=self.user.id,
+                receiver_id=receiver_id,
+                content=content,
+                is_image=is_image,
+                image_url=image_url
+            )
+            Contact.record_message(message)
+        return message
 
     @database_sync_to_async
     def edit_message(self, message_id, new_content):
         try:
-            message = Message.objects.get(id=message_id, sender=self.user)
+            message = Message.objects.get(id=message_id, sender_id=self.user.id)
             message.edit_message(new_content)
             return message
-        except Message.DoesNotExist:
+        except (Message.DoesNotExist, ValueError):
             return None
 
     @database_sync_to_async
-    def mark_messages_read(self, sender_id):
-        Message.objects.filter(
-            sender_id=sender_id,
-            receiver=self.user,
-            is_read=False
-        ).update(is_read=True)
-
-    @database_sync_to_async
-    def update_last_message(self, message):
-        Contact.objects.filter(
-            Q(user=message.sender, contact=message.receiver) |
-            Q(user=message.receiver, contact=message.sender)
-        ).update(last_message=message)
-
-    @database_sync_to_async
-    def set_user_online(self, is_online):
-        UserStatus.objects.update_or_create(
-            user=self.user,
-            defaults={'is_online': is_online}
-        )
+    def mark_messages_read(self, sender_id, up_to=None):
+        return Contact.mark_conversation_read(self.user.id, sender_id, up_to)
 
     async def notify_status_change(self, is_online):
-        # Get user's contacts
-        contacts = await self.get_user_contacts()
-        
-        # Notify all contacts about status change
-        for contact in contacts:
-            await self.channel_layer.group_send(
-                f"user_{contact}",
-                {
-                    'type': 'user_status',
-                    'user_id': self.user.id,
-                    'is_online': is_online
-                }
-            )
+        # Notify all contacts about status change, in concurrent batches
+        await presence.group_send_many(
+            self.channel_layer,
+            (f"user_{contact}" for contact in self.contact_ids),
+            {
+                'type': 'user_status',
+                'user_id': self.user.id,
+                'is_online': is_online
+            }
+        )
 
     @database_sync_to_async
     def get_user_contacts(self):
         return list(Contact.objects.filter(
-            contact=self.user
+            contact_id=self.user.id
         ).values_list('user_id', flat=True))
 
     async def user_status(self, event):
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             'type': 'user_status',
             'user_id': event['user_id'],
             'is_online': event['is_online']
-        }))
\ No newline at end of file
+        }, key=('user_status', event['user_id']))
\ No newline at end of file
@@ -0,0 +1,84 @@
+# messaging/db.py
+import contextvars
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+
+from . import metrics
+
+# [submitted at, started] for the call being awaited; the copied context
+# carries it into the executor thread
+_call_state = contextvars.ContextVar('db_call_state', default=None)
+
+_executors = {}
+
+
+def get_executor():
+    """
+    The thread pool for database calls when CHAT_DB_EXECUTOR_WORKERS is set,
+    else None. Every thread keeps its own connection, so size it to the
+    connections one process may hold.
+    """
+    workers = settings.CHAT_DB_EXECUTOR_WORKERS
+    if workers <= 0:
+        return None
+    executor = _executors.get(workers)
+    if executor is None:
+        executor = _executors.setdefault(workers, ThreadPoolExecutor(workers, thread_name_prefix='chat-db'))
+    return executor
+
+
+class InstrumentedDatabaseSyncToAsync(DatabaseSyncToAsync):
+    """
+    Channels' database_sync_to_async that records executor saturation:
+    queued and running calls, queue wait and run time (see messaging.metrics).
+
+    By default asgiref runs every call on one shared thread, one at a time,
+    for the whole process. With CHAT_DB_EXECUTOR_WORKERS set, calls run
+    concurrently on get_executor() instead; each call is self-contained
+    (its own transaction, no thread-local state shared between calls). The
+    executor is chosen when the function is wrapped, usually at import.
+    """
+
+    def __init__(self, func, thread_sensitive=True, executor=None):
+        if thread_sensitive and executor is None:
+            executor = get_executor()
+            thread_sensitive = executor is None
+        super().__init__(self._measured(func), thread_sensitive=thread_sensitive, executor=executor)
+
+    @staticmethod
+    def _measured(func):
+        @functools.wraps(func)
+        def run(*args, **kwargs):
+            started = time.perf_counter()
+            state = _call_state.get()
+            if state is not None and not state[1]:
+                state[1] = True
+                metrics.db_calls_queued.dec()
+                metrics.db_queue_wait_seconds.observe(started - state[0])
+            metrics.db_calls_running.inc()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                metrics.db_calls_running.dec()
+                metrics.db_call_seconds.observe(time.perf_counter() - started)
+        return run
+
+    async def __call__(self, *args, **kwargs):
+        state = [time.perf_counter(), False]
+        token = _call_state.set(state)
+        metrics.db_calls_queued.inc()
+        try:
+            return await super().__call__(*args, **kwargs)
+        finally:
+            _call_state.reset(token)
+            if not state[1]:
+                # Cancelled before it ever reached the executor
+                state[1] = True
+                metrics.db_calls_queued.dec()
+
+
+database_sync_to_async = InstrumentedDatabaseSyncToAsync
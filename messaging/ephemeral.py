@@ -0,0 +1,115 @@
+# messaging/ephemeral.py
+import asyncio
+import logging
+import time
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+_UNSET = object()
+
+
+class _State:
+    __slots__ = ('idle', 'sent', 'sent_at', 'pending', 'flush', 'expire')
+
+    def __init__(self, idle):
+        self.idle = idle
+        self.sent = idle
+        self.sent_at = float('-inf')
+        self.pending = _UNSET
+        self.flush = None
+        self.expire = None
+
+    def cancel(self):
+        for task in (self.flush, self.expire):
+            if task is not None:
+                task.cancel()
+        self.flush = self.expire = None
+        self.pending = _UNSET
+
+
+class EphemeralCoalescer:
+    """
+    Per-connection throttle for ephemeral state events such as typing.
+
+    Each key (e.g. ('typing', receiver_id)) carries a value. Only changes to
+    it are sent, at most one per `interval` seconds. A change inside the
+    interval is held back, and when the value flips back before the
+    interval ends nothing is sent at all. With an `idle` value, a key that
+    gets no updates for `timeout` seconds falls back to it ("stopped
+    typing"), and close() announces idle for every key that is not.
+
+    Channel layer traffic is then bounded by the number of active keys, not
+    by how often the client reports them. `send(key, value)` is awaited for
+    every change that goes out; the first element of the key labels the
+    chat_ephemeral_events_total metric.
+    """
+
+    def __init__(self, send, interval, timeout):
+        self.send = send
+        self.interval = interval
+        self.timeout = timeout
+        self._states = {}
+
+    async def update(self, key, value, idle=None):
+        """Report the current `value` of `key`; `idle` is the value it falls back to."""
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = _State(idle)
+
+        if state.expire is not None:
+            state.expire.cancel()
+            state.expire = None
+        if state.idle is not None and value != state.idle and self.timeout > 0:
+            state.expire = asyncio.ensure_future(self._expire(key, state))
+
+        if value == state.sent:
+            # Nothing to send; drop a held-back change this one reverts
+            outcome = 'unchanged' if state.pending is _UNSET else 'coalesced'
+            metrics.ephemeral_events.labels(key[0], outcome).inc()
+            state.pending = _UNSET
+            if state.flush is not None:
+                state.flush.cancel()
+                state.flush = None
+            return
+
+        wait = state.sent_at + self.interval - time.monotonic()
+        if wait <= 0:
+            await self._send(key, state, value)
+            return
+        if state.pending is not _UNSET:
+            metrics.ephemeral_events.labels(key[0], 'coalesced').inc()
+        state.pending = value
+        if state.flush is None:
+            state.flush = asyncio.ensure_future(self._flush_after(key, state, wait))
+
+    async def close(self):
+        """Drop held-back changes and announce idle for every key that is not idle."""
+        states, self._states = self._states, {}
+        for key, state in states.items():
+            state.cancel()
+            if state.idle is not None and state.sent != state.idle:
+                await self._send(key, state, state.idle)
+
+    async def _send(self, key, state, value):
+        state.sent = value
+        state.sent_at = time.monotonic()
+        metrics.ephemeral_events.labels(key[0], 'sent').inc()
+        try:
+            await self.send(key, value)
+        except Exception:
+            logger.exception("Sending ephemeral event %s failed", key)
+
+    async def _flush_after(self, key, state, delay):
+        await asyncio.sleep(delay)
+        state.flush = None
+        value, state.pending = state.pending, _UNSET
+        if value is not _UNSET and value != state.sent:
+            await self._send(key, state, value)
+
+    async def _expire(self, key, state):
+        await asyncio.sleep(self.timeout)
+        state.expire = None
+        metrics.ephemeral_events.labels(key[0], 'expired').inc()
+        await self.update(key, state.idle)
@@ -0,0 +1,92 @@
+# messaging/ids.py
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+# Generated message ids are time-ordered so they can be handed out before the
+# row is written and still sort like created_at. They are only used when
+# MESSAGE_ID_WORKER is set (required by CHAT_WRITE_BEHIND); otherwise the
+# database assigns ids. Layout (53 bits, so ids stay exact as JavaScript
+# numbers):
+#
+#   41 bits  milliseconds since ID_EPOCH_MS (~69 years)
+#    5 bits  worker id (MESSAGE_ID_WORKER, unique per process)
+#    7 bits  per-millisecond sequence
+ID_EPOCH_MS = 1704067200000  # 2024-01-01T00:00:00Z
+WORKER_BITS = 5
+SEQUENCE_BITS = 7
+MAX_WORKER = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+
+class MessageIdGenerator:
+    def __init__(self, worker_id):
+        if not 0 <= worker_id <= MAX_WORKER:
+            raise ValueError(f"Worker id must be between 0 and {MAX_WORKER}, got {worker_id}")
+        self.worker_id = worker_id
+        self._lock = threading.Lock()
+        self._last_ms = 0
+        self._sequence = 0
+
+    def next_id(self, timestamp_ms=None):
+        """
+        Return the next id. Ids never go backwards: when the clock stalls or the
+        sequence for a millisecond runs out, the id borrows the next millisecond.
+        """
+        if timestamp_ms is None:
+            timestamp_ms = int(time.time() * 1000)
+        with self._lock:
+            if timestamp_ms > self._last_ms:
+                self._last_ms = timestamp_ms
+                self._sequence = 0
+            elif self._sequence < MAX_SEQUENCE:
+                self._sequence += 1
+            else:
+                self._last_ms += 1
+                self._sequence = 0
+            return (
+                (self._last_ms - ID_EPOCH_MS) << (WORKER_BITS + SEQUENCE_BITS)
+                | self.worker_id << SEQUENCE_BITS
+                | self._sequence
+            )
+
+
+def max_id_at(timestamp_ms):
+    """The largest id any worker can have generated in millisecond `timestamp_ms`."""
+    return ((timestamp_ms - ID_EPOCH_MS + 1) << (WORKER_BITS + SEQUENCE_BITS)) - 1
+
+
+_generators = {}
+
+
+def worker_id():
+    """MESSAGE_ID_WORKER as an int, or None when the database assigns message ids."""
+    worker = settings.MESSAGE_ID_WORKER
+    if worker is None or worker == '':
+        return None
+    try:
+        worker = int(worker)
+    except (TypeError, ValueError):
+        raise ImproperlyConfigured(f"MESSAGE_ID_WORKER must be an integer, got {worker!r}")
+    if not 0 <= worker <= MAX_WORKER:
+        raise ImproperlyConfigured(f"MESSAGE_ID_WORKER must be between 0 and {MAX_WORKER}, got {worker}")
+    return worker
+
+
+def next_message_id():
+    """
+    The next generated id for this process. There is no default worker id:
+    two processes sharing one would mint the same ids in the same
+    millisecond, so MESSAGE_ID_WORKER has to be set explicitly.
+    """
+    worker = worker_id()
+    if worker is None:
+        raise ImproperlyConfigured(
+            "Generated message ids (CHAT_WRITE_BEHIND) need MESSAGE_ID_WORKER, unique per worker process"
+        )
+    generator = _generators.get(worker)
+    if generator is None:
+        generator = _generators.setdefault(worker, MessageIdGenerator(worker))
+    return generator.next_id()
@@ -0,0 +1,148 @@
+# messaging/ingest.py
+import asyncio
+import atexit
+import logging
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import DatabaseError, transaction
+
+from . import instrumentation, metrics
+from .db import database_sync_to_async
+from .models import Contact, Message
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriter:
+    """
+    Write-behind persistence for chat messages (CHAT_WRITE_BEHIND).
+
+    Consumers hand over fully built, unsaved Message instances and deliver
+    them right away. A background task collects submissions for up to
+    CHAT_INGEST_FLUSH_INTERVAL seconds (or CHAT_INGEST_BATCH_SIZE messages),
+    inserts them with one bulk_create, updates each conversation's Contact
+    rows once, and only then acks every message to the channel that sent it.
+
+    Messages are delivered before they are stored, so the module-level
+    writer drains itself when the process exits (see drain()).
+    """
+
+    def __init__(self):
+        self._queue = None
+        self._task = None
+        self._loop = None
+        # Taken off the queue but not yet persisted
+        self._batch = []
+
+    async def submit(self, message, reply_channel):
+        """Queue a message; waits when CHAT_INGEST_QUEUE_SIZE messages are already pending."""
+        self._ensure_running()
+        await self._queue.put((message, reply_channel))
+
+    def _ensure_running(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue(maxsize=settings.CHAT_INGEST_QUEUE_SIZE)
+            self._task = None
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        # The task is started from inside a consumer frame; don't bill its queries to that frame
+        instrumentation.detach()
+        while True:
+            self._batch = batch = [await self._queue.get()]
+            deadline = self._loop.time() + settings.CHAT_INGEST_FLUSH_INTERVAL
+            while len(batch) < settings.CHAT_INGEST_BATCH_SIZE:
+                timeout = deadline - self._loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self.flush(batch)
+            for _ in batch:
+                self._queue.task_done()
+
+    async def close(self):
+        """Wait until everything submitted so far is persisted, then stop the writer task."""
+        if self._task is None or self._loop is not asyncio.get_running_loop():
+            return
+        await self._queue.join()
+        self._task.cancel()
+        self._task = None
+
+    async def flush(self, batch):
+        try:
+            failed = await database_sync_to_async(self.persist)([message for message, _ in batch])
+        except Exception:
+            logger.exception("Write-behind: persisting %d messages failed", len(batch))
+            failed = {message.id for message, _ in batch}
+        self._batch = []
+
+        channel_layer = get_channel_layer()
+        for message, reply_channel in batch:
+            await metrics.observe_layer('send', channel_layer.send(reply_channel, {
+                'type': 'message_failed' if message.id in failed else 'message_ack',
+                'message_id': message.id,
+            }))
+
+    def drain(self):
+        """
+        Persist everything still queued or in flight, synchronously. Runs at
+        interpreter exit, when the event loop no longer runs the writer task.
+        No acks are sent; clients pick the messages up through delta sync.
+        """
+        pending = [message for message, _ in self._batch]
+        self._batch = []
+        if self._queue is not None:
+            while not self._queue.empty():
+                pending.append(self._queue.get_nowait()[0])
+        if not pending:
+            return
+        logger.warning("Write-behind: persisting %d queued messages at shutdown", len(pending))
+        try:
+            failed = self.persist(pending)
+        except Exception:
+            logger.exception("Write-behind: %d queued messages were lost at shutdown", len(pending))
+            return
+        if failed:
+            logger.error("Write-behind: %d queued messages were lost at shutdown", len(failed))
+
+    @classmethod
+    def persist(cls, messages):
+        """
+        Insert a batch and apply it to Contact rows. If the batch is rejected
+        (e.g. one message points at a deleted user), fall back to one
+        transaction per message so only the bad ones fail. Returns the ids of
+        messages that could not be stored.
+        """
+        try:
+            cls._insert(messages)
+            return set()
+        except DatabaseError:
+            if len(messages) == 1:
+                raise
+            logger.warning("Write-behind: batch of %d rejected, retrying one by one", len(messages))
+
+        failed = set()
+        for message in messages:
+            try:
+                cls._insert([message])
+            except DatabaseError:
+                logger.exception("Write-behind: message %s could not be stored", message.id)
+                failed.add(message.id)
+        return failed
+
+    @staticmethod
+    def _insert(messages):
+        with transaction.atomic():
+            Message.objects.bulk_create(messages)
+            Contact.record_messages(messages)
+
+
+writer = MessageWriter()
+atexit.register(writer.drain)
@@ -0,0 +1,197 @@
+# messaging/instrumentation.py
+"""
+Query count, DB time and serialization time for every DRF request and every
+ChatConsumer frame.
+
+A Timings object is bound to a context variable for the duration of a request
+or frame. The SQL execute wrapper installed on each connection adds to the
+current Timings, and because database_sync_to_async copies the context into
+its worker thread, queries made from consumers are attributed too.
+
+Endpoints declare budgets in a `query_budgets` dict that maps an action (or
+frame type) to the maximum number of queries it may run. Going over budget
+logs a warning and notifies `budget_listeners`. QueryBudgetAssertions turns
+that into a test failure.
+"""
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar('messaging_timings', default=None)
+
+# Callables receiving (endpoint, queries, budget) whenever a budget is exceeded
+budget_listeners = []
+
+
+class Timings:
+    __slots__ = ('endpoint', 'queries', 'db', 'ser', 'started', 'total', '_serializing')
+
+    def __init__(self, endpoint=None):
+        self.endpoint = endpoint
+        self.queries = 0
+        self.db = 0.0
+        self.ser = 0.0
+        self.started = time.perf_counter()
+        self.total = None
+        self._serializing = False
+
+    def stop(self):
+        self.total = time.perf_counter() - self.started
+
+    def server_timing(self):
+        """Value for the Server-Timing header, durations in milliseconds."""
+        return (
+            f'db;dur={self.db * 1000:.2f};desc="{self.queries} queries", '
+            f'ser;dur={self.ser * 1000:.2f}, '
+            f'total;dur={self.total * 1000:.2f}'
+        )
+
+
+@contextmanager
+def measure(endpoint=None):
+    """Bind a fresh Timings to the current context until the block exits."""
+    timings = Timings(endpoint)
+    token = _current.set(timings)
+    try:
+        yield timings
+    finally:
+        timings.stop()
+        _current.reset(token)
+
+
+def detach():
+    """
+    Stop attributing work in the current context to whatever request or frame
+    started it. Called at the top of long-lived background tasks, which
+    inherit the context of the code that spawned them.
+    """
+    _current.set(None)
+
+
+@contextmanager
+def serializing():
+    """Count the block as serialization time; nested blocks are only counted once."""
+    timings = _current.get()
+    if timings is None or timings._serializing:
+        yield
+        return
+    timings._serializing = True
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.ser += time.perf_counter() - started
+        timings._serializing = False
+
+
+# Transaction plumbing differs per backend (and inside TestCase), so it only
+# counts towards DB time, not towards the query count.
+TRANSACTION_STATEMENTS = ('BEGIN', 'SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO SAVEPOINT')
+
+
+def record_query(execute, sql, params, many, context):
+    timings = _current.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        if not (isinstance(sql, str) and sql.startswith(TRANSACTION_STATEMENTS)):
+            timings.queries += 1
+        timings.db += time.perf_counter() - started
+
+
+def install(sender=None, connection=None, **kwargs):
+    """connection_created receiver that adds record_query to each new connection."""
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+class EndpointStats:
+    """In-process aggregates per endpoint, served by the instrumentation view."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def record(self, timings, budget):
+        with self._lock:
+            entry = self._endpoints.setdefault(timings.endpoint, {
+                'count': 0, 'queries': 0, 'max_queries': 0, 'over_budget': 0,
+                'db_ms': 0.0, 'ser_ms': 0.0, 'total_ms': 0.0, 'budget': budget,
+            })
+            entry['count'] += 1
+            entry['queries'] += timings.queries
+            entry['max_queries'] = max(entry['max_queries'], timings.queries)
+            entry['db_ms'] += timings.db * 1000
+            entry['ser_ms'] += timings.ser * 1000
+            entry['total_ms'] += timings.total * 1000
+            entry['budget'] = budget
+            if budget is not None and timings.queries > budget:
+                entry['over_budget'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                endpoint: {
+                    'count': entry['count'],
+                    'budget': entry['budget'],
+                    'over_budget': entry['over_budget'],
+                    'max_queries': entry['max_queries'],
+                    'avg_queries': round(entry['queries'] / entry['count'], 2),
+                    'avg_db_ms': round(entry['db_ms'] / entry['count'], 3),
+                    'avg_ser_ms': round(entry['ser_ms'] / entry['count'], 3),
+                    'avg_total_ms': round(entry['total_ms'] / entry['count'], 3),
+                }
+                for endpoint, entry in sorted(self._endpoints.items())
+            }
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+
+
+stats = EndpointStats()
+
+
+def finish(timings, budget=None):
+    """Record a finished request or frame and enforce its query budget."""
+    stats.record(timings, budget)
+    if budget is not None and timings.queries > budget:
+        logger.warning(
+            "%s ran %d queries, over its budget of %d", timings.endpoint, timings.queries, budget
+        )
+        for listener in list(budget_listeners):
+            listener(timings.endpoint, timings.queries, budget)
+
+
+class InstrumentedSerializerMixin:
+    """Counts to_representation as serialization time of the current request."""
+
+    def to_representation(self, instance):
+        with serializing():
+            return super().to_representation(instance)
+
+
+class QueryBudgetAssertions:
+    """TestCase mixin: fail when an endpoint called inside the block goes over its query budget."""
+
+    @contextmanager
+    def assertWithinQueryBudget(self):
+        exceeded = []
+        listener = lambda *args: exceeded.append(args)
+        budget_listeners.append(listener)
+        try:
+            yield
+        finally:
+            budget_listeners.remove(listener)
+        if exceeded:
+            self.fail("Query budget exceeded: " + ", ".join(
+                f"{endpoint} ran {queries} queries (budget {budget})"
+                for endpoint, queries, budget in exceeded
+            ))
@@ -0,0 +1,432 @@
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import timedelta
+
+import django
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.test import Client, RequestFactory, override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework_simplejwt.tokens import AccessToken
+
+from messaging import ingest, seeding, wire
+from messaging.models import Contact, Message, conversation_key_for
+from messaging.pagination import KeysetPagination
+from messaging.renderers import FastJSONRenderer
+from messaging.serializers import (
+    ContactRowSerializer,
+    ContactSerializer,
+    MessageRowSerializer,
+    MessageSerializer,
+)
+
+User = get_user_model()
+
+FRAME_MIX = ('message', 'message', 'message', 'message', 'typing', 'typing', 'edit', 'read')
+
+
+class QueryCounter:
+    """Counts SQL statements on every database connection, in any thread."""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self, sender=None, connection=None, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def __enter__(self):
+        connection_created.connect(self.install)
+        self.install(connection=connection)
+        return self
+
+    def __exit__(self, *exc_info):
+        connection_created.disconnect(self.install)
+        if self in connection.execute_wrappers:
+            connection.execute_wrappers.remove(self)
+
+
+def summarize(samples):
+    """Latency summary in milliseconds (nearest-rank percentiles)."""
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+
+    def percentile(p):
+        return round(ordered[max(0, int(round(p / 100 * len(ordered))) - 1)] * 1000, 3)
+
+    return {
+        'count': len(ordered),
+        'mean': round(sum(ordered) / len(ordered) * 1000, 3),
+        'p50': percentile(50),
+        'p95': percentile(95),
+        'p99': percentile(99),
+        'max': round(ordered[-1] * 1000, 3),
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the chat websocket (via home.asgi) and the contact/message list "
+        "endpoints against a throwaway test database, and write the results as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=20, help="Concurrent websocket clients (default: 20).")
+        parser.add_argument('--frames', type=int, default=50, help="Frames sent per client (default: 50).")
+        parser.add_argument('--contacts', type=int, default=200, help="Contacts of the REST benchmark user (default: 200).")
+        parser.add_argument('--history', type=int, default=5000, help="Messages in the benchmarked conversation (default: 5000).")
+        parser.add_argument('--requests', type=int, default=50, help="Requests per REST endpoint (default: 50).")
+        parser.add_argument(
+            '--seed-users', type=int, default=0,
+            help="Users in a background dataset generated before measuring, see seed_chat (default: 0)."
+        )
+        parser.add_argument(
+            '--seed-messages', type=int, default=0,
+            help="Messages in the background dataset (default: 0)."
+        )
+        parser.add_argument(
+            '--protocol', choices=sorted(wire.CODECS), default=wire.JSONCodec.subprotocol,
+            help="Websocket subprotocol of the clients (default: chat.json)."
+        )
+        parser.add_argument('--write-behind', action='store_true', help="Run the websocket clients with CHAT_WRITE_BEHIND enabled.")
+        parser.add_argument('--output', default='benchmark.json', help="Where to write the JSON results (default: benchmark.json).")
+        parser.add_argument('--compare', help="Earlier results file to print a comparison against.")
+
+    def handle(self, *args, **options):
+        database_dir = None
+        if connection.vendor == 'sqlite':
+            # The in-memory test database fails concurrent writes (with
+            # CHAT_DB_EXECUTOR_WORKERS) instead of waiting for the lock; a file
+            # in WAL mode takes them in turn, like a deployed database
+            database_dir = tempfile.mkdtemp()
+            connection.settings_dict['TEST']['NAME'] = os.path.join(database_dir, 'benchmark.sqlite3')
+        logging.getLogger('messaging').setLevel(logging.WARNING)
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            with override_settings(
+                CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+                CHAT_WRITE_BEHIND=options['write_behind'],
+                # The benchmark is the only writer of its throwaway database
+                MESSAGE_ID_WORKER=settings.MESSAGE_ID_WORKER or (0 if options['write_behind'] else None),
+                PRESENCE_GRACE_SECONDS=0,
+                PRESENCE_FLUSH_INTERVAL=0,
+                ALLOWED_HOSTS=['*'],
+            ):
+                if options['seed_users']:
+                    seeding.seed_dataset(
+                        users=options['seed_users'], messages=options['seed_messages'],
+                        prefix='bench-seed', log=lambda line: self.stdout.write(line),
+                    )
+                results = {
+                    'meta': self.meta(options),
+                    'rest': self.benchmark_rest(options),
+                    'serialization': self.benchmark_serialization(options),
+                    'websocket': self.benchmark_websocket(options),
+                }
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            if database_dir:
+                shutil.rmtree(database_dir, ignore_errors=True)
+
+        with open(options['output'], 'w') as fh:
+            json.dump(results, fh, indent=2)
+        self.report(results)
+        if options['compare']:
+            with open(options['compare']) as fh:
+                self.compare(json.load(fh), results)
+        self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
+
+    def meta(self, options):
+        try:
+            commit = subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            commit = None
+        return {
+            'commit': commit,
+            'timestamp': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'params': {
+                key: options[key]
+                for key in (
+                    'clients', 'frames', 'contacts', 'history', 'requests',
+                    'seed_users', 'seed_messages', 'write_behind', 'protocol',
+                )
+            },
+            # Read at import, so it can only be set through the environment
+            'db_executor_workers': settings.CHAT_DB_EXECUTOR_WORKERS,
+        }
+
+    # Datasets
+
+    def create_users(self, prefix, count):
+        ids = seeding.create_users(prefix, count)
+        return list(User.objects.filter(id__in=ids).order_by('id'))
+
+    def create_messages(self, pairs_with_counts):
+        """Insert `count` alternating messages per pair, oldest first, then fix up Contacts."""
+        specs = (
+            (a.id, b.id, f"history message {i}") if i % 2 else (b.id, a.id, f"history message {i}")
+            for (a, b), count in pairs_with_counts
+            for i in range(count)
+        )
+        seeding.create_messages(specs, timezone.now() - timedelta(days=30), worker_id=0)
+        user_ids = {user.id for pair, _ in pairs_with_counts for user in pair}
+        seeding.refresh_contacts(Contact.objects.filter(user_id__in=user_ids))
+
+    # REST
+
+    def benchmark_rest(self, options):
+        owner = self.create_users('rest-owner', 1)[0]
+        others = self.create_users('rest-contact', options['contacts'])
+        peer = others[0]
+        pairs = [(owner, other) for other in others]
+        seeding.connect_users((a.id, b.id) for a, b in pairs)
+        self.create_messages([((owner, peer), options['history'])] + [(pair, 1) for pair in pairs[1:]])
+
+        self.rest_owner, self.rest_peer = owner, peer
+        client = Client(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(owner)}")
+        endpoints = {
+            'contacts_list': ('/api/messaging/contacts/', {}),
+            'messages_list': ('/api/messaging/messages/', {'contact': peer.id}),
+            # Matches every history message: the worst case for ranking
+            'messages_search': ('/api/messaging/messages/search/', {'q': 'history message'}),
+        }
+        results = {}
+        for name, (path, params) in endpoints.items():
+            results[name] = self.time_requests(client, path, params, options['requests'])
+        return results
+
+    def time_requests(self, client, path, params, requests):
+        samples = []
+        with QueryCounter() as queries, contextlib.redirect_stdout(io.StringIO()):
+            started = time.perf_counter()
+            for _ in range(requests):
+                t0 = time.perf_counter()
+                response = client.get(path, params)
+                samples.append(time.perf_counter() - t0)
+                if response.status_code != 200:
+                    raise RuntimeError(f"{path} returned {response.status_code}")
+            elapsed = time.perf_counter() - started
+        return {
+            'latency_ms': summarize(samples),
+            'throughput_rps': round(requests / elapsed, 2),
+            'queries_per_request': round(queries.count / requests, 2),
+        }
+
+    # Serialization
+
+    def benchmark_serialization(self, options):
+        """
+        Time serializing and rendering one full message page and the contact
+        list: DRF serializers + JSONRenderer against the row fast path + FastJSONRenderer.
+        """
+        owner, peer = self.rest_owner, self.rest_peer
+        context = {'request': RequestFactory().get('/', HTTP_HOST='testserver')}
+        messages = Message.objects.filter(
+            conversation_key=conversation_key_for(owner.id, peer.id)
+        ).with_read_state().select_related('sender').order_by('-created_at', '-id')[:KeysetPagination.max_page_size]
+        contacts = Contact.objects.filter(user=owner).with_read_state()\
+            .select_related('contact', 'contact__userstatus', 'last_message')
+
+        cases = {
+            'messages_page': (
+                list(messages), MessageSerializer,
+                list(messages.values(*MessageRowSerializer.columns)), MessageRowSerializer,
+            ),
+            'contacts_list': (
+                list(contacts), ContactSerializer,
+                list(contacts.values(*ContactRowSerializer.columns)), ContactRowSerializer,
+            ),
+        }
+        results = {}
+        with contextlib.redirect_stdout(io.StringIO()):
+            for name, (instances, serializer_class, rows, row_serializer_class) in cases.items():
+                drf = self.time_calls(options['requests'], lambda: JSONRenderer().render(
+                    serializer_class(instances, many=True, context=context).data
+                ))
+                fast = self.time_calls(options['requests'], lambda: FastJSONRenderer().render(
+                    row_serializer_class(rows, context=context).data
+                ))
+                results[name] = {
+                    'items': len(rows),
+                    'drf_ms': summarize(drf),
+                    'fast_ms': summarize(fast),
+                    'speedup': round(sum(drf) / sum(fast), 2),
+                }
+        return results
+
+    @staticmethod
+    def time_calls(count, func):
+        samples = []
+        for _ in range(count):
+            t0 = time.perf_counter()
+            func()
+            samples.append(time.perf_counter() - t0)
+        return samples
+
+    # Websocket
+
+    def benchmark_websocket(self, options):
+        clients = max(2, options['clients'] + options['clients'] % 2)
+        users = self.create_users('ws-user', clients)
+        pairs = list(zip(users[::2], users[1::2]))
+        seeding.connect_users((a.id, b.id) for a, b in pairs)
+        partners = {}
+        for a, b in pairs:
+            partners[a.id], partners[b.id] = b, a
+
+        with QueryCounter() as queries:
+            latencies, frames, elapsed = async_to_sync(self.run_clients)(
+                users, partners, options['frames'], wire.CODECS[options['protocol']]
+            )
+
+        return {
+            'clients': clients,
+            'frames': frames,
+            'duration_s': round(elapsed, 3),
+            'throughput_fps': round(frames / elapsed, 2),
+            'latency_ms': {kind: summarize(samples) for kind, samples in latencies.items()},
+            'queries': queries.count,
+            'queries_per_frame': round(queries.count / frames, 2),
+        }
+
+    async def run_clients(self, users, partners, frames, codec):
+        from home.asgi import application
+
+        communicators = []
+        for user in users:
+            communicator = WebsocketCommunicator(
+                application, f"/ws/chat/?token={AccessToken.for_user(user)}", subprotocols=[codec.subprotocol]
+            )
+            connected, _ = await communicator.connect(timeout=10)
+            if not connected:
+                raise RuntimeError(f"Websocket connection for {user} was rejected")
+            communicators.append(communicator)
+
+        latencies = {'message': [], 'edit': []}
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            self.run_client(communicator, codec, user, partners[user.id], frames, latencies)
+            for communicator, user in zip(communicators, users)
+        ))
+        await ingest.writer.close()
+        elapsed = time.perf_counter() - started
+
+        for communicator in communicators:
+            await communicator.disconnect()
+        return latencies, frames * len(users), elapsed
+
+    async def run_client(self, communicator, codec, user, partner, frames, latencies):
+        last_message_id = None
+        for n in range(frames):
+            kind = FRAME_MIX[n % len(FRAME_MIX)]
+            if kind == 'edit' and last_message_id is None:
+                kind = 'message'
+            content = f"bench {user.id} {n}"
+
+            if kind == 'message':
+                frame = {'type': 'message', 'receiver': partner.id, 'content': content}
+                match = lambda event: event.get('content') == content and event.get('senderId') == str(user.id)
+            elif kind == 'edit':
+                frame = {'type': 'edit', 'message_id': last_message_id, 'content': content}
+                match = lambda event: event.get('type') == 'message_edited' and event['message']['content'] == content
+            elif kind == 'typing':
+                frame = {'type': 'typing', 'receiver': partner.id, 'is_typing': n % 2 == 0}
+                match = None
+            else:
+                frame = {'type': 'read', 'sender': partner.id}
+                match = None
+
+            t0 = time.perf_counter()
+            if codec.binary:
+                await communicator.send_to(bytes_data=codec.encode(frame))
+            else:
+                await communicator.send_to(text_data=codec.encode(frame))
+            if match is None:
+                continue
+            while True:
+                data = await communicator.receive_from(timeout=10)
+                event = wire.decode(bytes_data=data) if isinstance(data, bytes) else wire.decode(data)
+                if match(event):
+                    break
+            latencies[kind].append(time.perf_counter() - t0)
+            if kind == 'message':
+                last_message_id = int(event['id'])
+
+    # Output
+
+    def report(self, results):
+        for name, result in results['rest'].items():
+            latency = result['latency_ms']
+            self.stdout.write(
+                f"{name:<16} p50 {latency['p50']:>8} ms  p95 {latency['p95']:>8} ms  p99 {latency['p99']:>8} ms  "
+                f"{result['throughput_rps']:>8} req/s  {result['queries_per_request']} queries/req"
+            )
+        for name, result in results['serialization'].items():
+            self.stdout.write(
+                f"ser {name:<12} {result['items']} items: DRF p50 {result['drf_ms']['p50']} ms, "
+                f"fast p50 {result['fast_ms']['p50']} ms ({result['speedup']}x)"
+            )
+        ws = results['websocket']
+        for kind, latency in ws['latency_ms'].items():
+            if latency['count']:
+                self.stdout.write(
+                    f"ws {kind:<13} p50 {latency['p50']:>8} ms  p95 {latency['p95']:>8} ms  p99 {latency['p99']:>8} ms"
+                )
+        self.stdout.write(
+            f"ws total         {ws['frames']} frames from {ws['clients']} clients in {ws['duration_s']} s: "
+            f"{ws['throughput_fps']} frames/s, {ws['queries_per_frame']} queries/frame"
+        )
+
+    def compare(self, before, after):
+        self.stdout.write(f"Compared with {before['meta'].get('commit')}:")
+        rows = [
+            (f"{name} {key}", before['rest'][name]['latency_ms'][key], after['rest'][name]['latency_ms'][key])
+            for name in after['rest'] if name in before['rest']
+            for key in ('p50', 'p95', 'p99')
+        ]
+        rows += [
+            (f"ws {kind} {key}", before['websocket']['latency_ms'][kind][key], latency[key])
+            for kind, latency in after['websocket']['latency_ms'].items()
+            if latency['count'] and before['websocket']['latency_ms'].get(kind, {}).get('count')
+            for key in ('p50', 'p95', 'p99')
+        ]
+        rows += [
+            (f"ser {name} fast p50", before['serialization'][name]['fast_ms']['p50'], result['fast_ms']['p50'])
+            for name, result in after['serialization'].items()
+            if name in before.get('serialization', {})
+        ]
+        rows.append(('ws frames/s', before['websocket']['throughput_fps'], after['websocket']['throughput_fps']))
+        for label, old, new in rows:
+            change = (new - old) / old * 100 if old else 0
+            self.stdout.write(f"  {label:<24} {old:>10} -> {new:>10} ({change:+.1f}%)")
@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+
+from messaging.models import Contact
+
+
+class Command(BaseCommand):
+    help = "Recompute Contact.unread_count from the read watermarks and fix any drift."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help="Number of contacts checked per query (default: 1000)."
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help="Report drifted counters without writing them."
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        dry_run = options['dry_run']
+        checked = fixed = 0
+        last_id = 0
+
+        while True:
+            ids = list(
+                Contact.objects.filter(id__gt=last_id)
+                .order_by('id')
+                .values_list('id', flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+            last_id = ids[-1]
+            checked += len(ids)
+
+            drifted = list(
+                Contact.objects.filter(id__in=ids)
+                .annotate(actual=Contact.unread_count_subquery())
+                .exclude(unread_count=F('actual'))
+                .values_list('id', 'unread_count', 'actual')
+            )
+            for contact_id, stored, actual in drifted:
+                self.stdout.write(f"Contact {contact_id}: stored {stored}, actual {actual}")
+            fixed += len(drifted)
+
+            if drifted and not dry_run:
+                with transaction.atomic():
+                    Contact.objects.filter(id__in=[row[0] for row in drifted]).update(
+                        unread_count=Contact.unread_count_subquery()
+                    )
+
+        verb = "Found" if dry_run else "Fixed"
+        self.stdout.write(self.style.SUCCESS(
+            f"Checked {checked} contacts. {verb} {fixed} drifted unread counters."
+        ))
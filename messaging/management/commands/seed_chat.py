@@ -0,0 +1,73 @@
+from datetime import datetime
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from messaging.seeding import SEED_ID_WORKER, seed_dataset
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate a deterministic chat dataset (users, contacts, messages) from a seed, "
+        "using chunked bulk inserts."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000, help="Number of users (default: 1000).")
+        parser.add_argument('--messages', type=int, default=100000, help="Number of messages (default: 100000).")
+        parser.add_argument(
+            '--contacts-per-user', type=int, default=20,
+            help="Approximate contacts per user (default: 20)."
+        )
+        parser.add_argument('--seed', type=int, default=0, help="Random seed (default: 0).")
+        parser.add_argument(
+            '--prefix', default='seed',
+            help="Prefix for generated usernames and emails (default: seed)."
+        )
+        parser.add_argument('--days', type=int, default=365, help="Days of history to spread messages over (default: 365).")
+        parser.add_argument(
+            '--end', type=datetime.fromisoformat,
+            help="ISO timestamp of the newest message (default: today 00:00 UTC). "
+                 "Pass it to get identical rows on every run."
+        )
+        parser.add_argument(
+            '--read-ratio', type=float, default=0.9,
+            help="Share of the history every user has read; later messages are unread (default: 0.9)."
+        )
+        parser.add_argument(
+            '--id-worker', type=int, default=SEED_ID_WORKER,
+            help=f"Worker bits for generated message ids (default: {SEED_ID_WORKER}). "
+                 "Use a different one for each dataset seeded over the same time range."
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=5000,
+            help="Rows per bulk insert (default: 5000)."
+        )
+
+    def handle(self, *args, **options):
+        if options['users'] < 2:
+            raise CommandError("--users must be at least 2.")
+        if User.objects.filter(email__startswith=options['prefix'], email__endswith='@seed.local').exists():
+            raise CommandError(
+                f"Users with prefix '{options['prefix']}' already exist; pass a different --prefix."
+            )
+
+        summary = seed_dataset(
+            users=options['users'],
+            messages=options['messages'],
+            contacts_per_user=options['contacts_per_user'],
+            seed=options['seed'],
+            prefix=options['prefix'],
+            days=options['days'],
+            end=options['end'],
+            read_ratio=options['read_ratio'],
+            chunk_size=options['chunk_size'],
+            worker_id=options['id_worker'],
+            log=self.stdout.write,
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Created {summary['users']} users, {summary['contacts']} contacts "
+            f"and {summary['messages']} messages."
+        ))
@@ -0,0 +1,233 @@
+# messaging/metrics.py
+"""
+Process-local metrics in the Prometheus text exposition format (0.0.4),
+served at /metrics.
+
+Updating a metric costs one lock acquisition and a dict lookup, so the
+instrumentation stays on in production. Every Daphne process keeps its own
+values; scrape each process and aggregate in Prometheus.
+"""
+import bisect
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in (*zip(names, values), *extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children = {}
+        if not self.labelnames:
+            self._default = self.labels()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def labels(self, *values):
+        """The child metric for one combination of label values."""
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}")
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            children = list(self._children.items())
+        for values, child in children:
+            lines.extend(self._samples(values, child))
+        return lines
+
+    def _samples(self, values, child):
+        yield f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.get())}"
+
+
+class _Value:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._value = 0.0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def get(self):
+        return self._value
+
+
+class _GaugeValue(_Value):
+    def dec(self, amount=1):
+        with self._lock:
+            self._value -= amount
+
+    def set(self, value):
+        self._value = float(value)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def _new_child(self):
+        return _GaugeValue()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def dec(self, amount=1):
+        self._default.dec(amount)
+
+    def set(self, value):
+        self._default.set(value)
+
+    def get(self):
+        return self._default.get()
+
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self._lock = threading.Lock()
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def snapshot(self):
+        with self._lock:
+            return list(self._counts), self._sum
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def _samples(self, values, child):
+        counts, total = child.snapshot()
+        cumulative = 0
+        for bound, count in zip((*self.buckets, float('inf')), counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, values, [('le', _format_value(bound))])
+            yield f"{self.name}_bucket{labels} {_format_value(cumulative)}"
+        labels = _format_labels(self.labelnames, values)
+        yield f"{self.name}_sum{labels} {_format_value(total)}"
+        yield f"{self.name}_count{labels} {_format_value(cumulative)}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+websocket_connections = Gauge(
+    'chat_websocket_connections', 'Open chat websocket connections in this process.'
+)
+frames_received = Counter(
+    'chat_websocket_frames_received_total', 'Websocket frames received, by frame type.', ['type']
+)
+frames_sent = Counter(
+    'chat_websocket_frames_sent_total', 'Websocket frames sent, by frame type.', ['type']
+)
+bytes_sent = Counter(
+    'chat_websocket_sent_bytes_total', 'Payload bytes of the websocket frames sent, by encoding.', ['encoding']
+)
+outbox_events = Counter(
+    'chat_websocket_outbox_events_total',
+    'Queued outbound frames merged into a newer one, dropped, or overflowing a slow client (closed).',
+    ['outcome'],
+)
+frame_seconds = Histogram(
+    'chat_websocket_frame_seconds',
+    'Time from receiving a frame until its handler, including queueing the frames it sends, is done.',
+    ['type'],
+)
+ephemeral_events = Counter(
+    'chat_ephemeral_events_total',
+    'Ephemeral state updates (e.g. typing) by type and outcome: sent, unchanged, coalesced or expired.',
+    ['type', 'outcome'],
+)
+channel_layer_seconds = Histogram(
+    'chat_channel_layer_seconds', 'Channel layer call latency, by operation.', ['operation']
+)
+db_calls_queued = Gauge(
+    'chat_db_calls_queued', 'database_sync_to_async calls waiting for the DB executor.'
+)
+db_calls_running = Gauge(
+    'chat_db_calls_running', 'database_sync_to_async calls running on the DB executor.'
+)
+db_queue_wait_seconds = Histogram(
+    'chat_db_queue_wait_seconds', 'Time database_sync_to_async calls waited for the DB executor.'
+)
+db_call_seconds = Histogram(
+    'chat_db_call_seconds', 'Time database_sync_to_async calls ran on the DB executor.'
+)
+
+
+async def observe_layer(operation, awaitable):
+    """Await a channel layer call and record its latency."""
+    started = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        channel_layer_seconds.labels(operation).observe(time.perf_counter() - started)
@@ -1,33 +1,192 @@
+import threading
+import time
+from collections import OrderedDict
 from urllib.parse import parse_qs
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
 from rest_framework_simplejwt.tokens import AccessToken
 from channels.middleware import BaseMiddleware
-from asgiref.sync import sync_to_async
 from django.contrib.auth import get_user_model
 import logging
 
+from . import instrumentation
+from .db import database_sync_to_async
+
 logger = logging.getLogger(__name__)
 
 User = get_user_model()
 
+
+class UserCache:
+    """
+    Bounded, thread-safe LRU of user records keyed by id, with a TTL.
+
+    A cached None records that the user does not exist or is inactive, so
+    tokens of removed users do not hit the database on every connect.
+    Entries are dropped on User save/delete (see messaging.signals); the TTL
+    bounds staleness for changes made by other processes.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id, default=None):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return default
+            user, expires = entry
+            if expires < time.monotonic():
+                del self._entries[user_id]
+                return default
+            self._entries.move_to_end(user_id)
+            return user
+
+    def set(self, user_id, user):
+        with self._lock:
+            self._entries[user_id] = (user, time.monotonic() + self.ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+user_cache = UserCache(settings.WS_USER_CACHE_SIZE, settings.WS_USER_CACHE_TTL)
+
+# Cache miss marker; None is a cached "no such active user"
+MISSING = object()
+
+
+def get_cached_user(user_id):
+    """The active User for `user_id` from the cache, loading it on a miss; None if there is none."""
+    user = user_cache.get(user_id, MISSING)
+    if user is MISSING:
+        try:
+            user = User.objects.get(pk=user_id, is_active=True)
+        except User.DoesNotExist:
+            user = None
+        user_cache.set(user_id, user)
+    return user
+
+
+class TokenUser:
+    """
+    Websocket user built from a validated access token without a database hit.
+
+    `id`, `pk` and the auth flags come from the token claims; scopes only
+    get one from TokenAuthMiddleware after it checked that the user still
+    exists and is active. Any other attribute loads the full User through
+    the user cache, so from async code call `await user.aload()` first.
+    """
+    is_authenticated = True
+    is_anonymous = False
+
+    def __init__(self, token):
+        self.id = self.pk = token[api_settings.USER_ID_CLAIM]
+        self._user = MISSING
+
+    def load(self):
+        """The full User, or None once it was deleted or deactivated."""
+        if self._user is MISSING:
+            self._user = get_cached_user(self.id)
+        return self._user
+
+    async def aload(self):
+        if self._user is MISSING:
+            user = user_cache.get(self.id, MISSING)
+            if user is MISSING:
+                user = await database_sync_to_async(get_cached_user)(self.id)
+            self._user = user
+        return self._user
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        user = self.load()
+        if user is None:
+            raise AttributeError(f"User {self.id} no longer exists or is inactive")
+        return getattr(user, name)
+
+    def __str__(self):
+        return f"TokenUser {self.id}"
+
+
 class TokenAuthMiddleware(BaseMiddleware):
     async def __call__(self, scope, receive, send):
         query_string = parse_qs(scope["query_string"].decode())
         token = query_string.get("token", [None])[0]
 
+        scope["user"] = AnonymousUser()
         if token:
             try:
-                logger.info(f"Received WebSocket token: {token}")  # ✅ Log token for debugging
-
-                access_token = AccessToken(token)
-                user = await sync_to_async(User.objects.get)(id=access_token["user_id"])
-                scope["user"] = user
-                logger.info(f"User authenticated: {user.username}")
-            except Exception as e:
-                logger.warning(f"Invalid token: {e}")
-                scope["user"] = AnonymousUser()
+                user = TokenUser(AccessToken(token))
+            except (TokenError, KeyError) as e:
+                logger.warning("Invalid WebSocket token: %s", e)
+            else:
+                # A token outlives its user: reject deleted and deactivated accounts
+                if await user.aload() is None:
+                    logger.warning("WebSocket token for missing or inactive user %s", user.id)
+                else:
+                    scope["user"] = user
+                    logger.debug("WebSocket user authenticated: %s", user.id)
         else:
             logger.warning("No token found in WebSocket request")
-            scope["user"] = AnonymousUser()
 
         return await super().__call__(scope, receive, send)
+
+
+class ServerTimingMiddleware:
+    """
+    HTTP middleware that measures each request (see messaging.instrumentation)
+    and checks the view's `query_budgets`. The Server-Timing header is only
+    added with DEBUG or SERVER_TIMING_HEADER on, as it tells clients how
+    much database work a request took.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        with instrumentation.measure() as timings:
+            response = self.get_response(request)
+        return self.finish(request, response, timings)
+
+    async def __acall__(self, request):
+        with instrumentation.measure() as timings:
+            response = await self.get_response(request)
+        return self.finish(request, response, timings)
+
+    @staticmethod
+    def finish(request, response, timings):
+        if settings.DEBUG or settings.SERVER_TIMING_HEADER:
+            response['Server-Timing'] = timings.server_timing()
+
+        view = getattr(request.resolver_match, 'func', None)
+        view_class = getattr(view, 'cls', None)
+        if view_class is not None:
+            method = request.method.lower()
+            action = (getattr(view, 'actions', None) or {}).get(method, method)
+            timings.endpoint = f"{view_class.__name__}.{action}"
+            instrumentation.finish(timings, getattr(view_class, 'query_budgets', {}).get(action))
+        return response
@@ -0,0 +1,44 @@
+from django.db import migrations, models
+
+
+def backfill_conversation_key(apps, schema_editor):
+    """Populate conversation_key one (sender, receiver) pair at a time."""
+    Message = apps.get_model('messaging', 'Message')
+    pairs = (
+        Message.objects.filter(conversation_key='')
+        .order_by()
+        .values_list('sender_id', 'receiver_id')
+        .distinct()
+    )
+    for sender_id, receiver_id in list(pairs):
+        low, high = sorted((sender_id, receiver_id))
+        Message.objects.filter(
+            sender_id=sender_id,
+            receiver_id=receiver_id,
+            conversation_key='',
+        ).update(conversation_key=f"{low}:{high}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='conversation_key',
+            field=models.CharField(default='', editable=False, max_length=41),
+            preserve_default=False,
+        ),
+        migrations.RunPython(backfill_conversation_key, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation_key', 'created_at', 'id'], name='message_conversation_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('is_read', False)), fields=['receiver', 'sender'], name='message_unread_idx'),
+        ),
+    ]
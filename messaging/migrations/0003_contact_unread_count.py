@@ -0,0 +1,30 @@
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_unread_count(apps, schema_editor):
+    Contact = apps.get_model('messaging', 'Contact')
+    Message = apps.get_model('messaging', 'Message')
+    unread = Message.objects.filter(
+        sender=OuterRef('contact'),
+        receiver=OuterRef('user'),
+        is_read=False
+    ).order_by().values('receiver').annotate(count=Count('id')).values('count')
+    Contact.objects.update(unread_count=Coalesce(Subquery(unread), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0002_message_conversation_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contact',
+            name='unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_unread_count, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,74 @@
+from django.db import migrations, models
+from django.db.models import Count, Exists, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from messaging import search
+
+
+def backfill_read_watermark(apps, schema_editor):
+    """
+    Move each watermark to just before the first unread message from the
+    contact, or to their last message when everything is read, so every
+    unread message stays unread. Then recount from the watermark.
+    """
+    Contact = apps.get_model('messaging', 'Contact')
+    Message = apps.get_model('messaging', 'Message')
+    received = Message.objects.filter(sender=OuterRef('contact'), receiver=OuterRef('user')).order_by()
+    first_unread = received.filter(is_read=False).order_by('id').values('id')[:1]
+    last_received = received.order_by('-id').values('id')[:1]
+    Contact.objects.update(last_read_message_id=Coalesce(
+        Subquery(first_unread) - Value(1), Subquery(last_received), Value(0),
+        output_field=models.BigIntegerField(),
+    ))
+    unread = received.filter(id__gt=OuterRef('last_read_message_id'))\
+        .values('receiver').annotate(count=Count('id')).values('count')
+    Contact.objects.update(unread_count=Coalesce(Subquery(unread), 0))
+
+
+def restore_is_read(apps, schema_editor):
+    Contact = apps.get_model('messaging', 'Contact')
+    Message = apps.get_model('messaging', 'Message')
+    Message.objects.filter(Exists(Contact.objects.filter(
+        user=OuterRef('receiver'), contact=OuterRef('sender'), last_read_message_id__gte=OuterRef('id'),
+    ))).update(is_read=True)
+
+
+def reinstall_search_triggers(apps, schema_editor):
+    # SQLite drops the triggers when a field change rebuilds messaging_message
+    search.install_triggers(schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0006_message_sync_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contact',
+            name='last_read_message_id',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='contact',
+            name='read_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(backfill_read_watermark, restore_is_read),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='message_unread_idx',
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['receiver', 'sender', 'id'], name='message_unread_idx'),
+        ),
+        # Runs after the field is restored when migrating backwards
+        migrations.RunPython(migrations.RunPython.noop, reinstall_search_triggers),
+        migrations.RemoveField(
+            model_name='message',
+            name='is_read',
+        ),
+        migrations.RunPython(reinstall_search_triggers, migrations.RunPython.noop),
+    ]
@@ -1,22 +1,52 @@
 # messaging/models.py
+import time
+from collections import defaultdict
+
+from django.conf import settings
 from django.db import models
+from django.db.models.functions import Coalesce
 from django.contrib.auth import get_user_model
 from django.utils.timezone import now
+from . import ids
 
 User = get_user_model()
 
+def conversation_key_for(user_a_id, user_b_id):
+    """Canonical identifier for the conversation between two users."""
+    low, high = sorted((int(user_a_id), int(user_b_id)))
+    return f"{low}:{high}"
+
+
+class MessageQuerySet(models.QuerySet):
+    def with_read_state(self):
+        """Annotate `is_read`: whether the receiver's read watermark has reached the message."""
+        return self.annotate(is_read=Contact.has_read(models.OuterRef('id')))
+
+
 class Message(models.Model):
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_messages')
     receiver = models.ForeignKey(User, on_delete=models.CASCADE, related_name='received_messages')
     content = models.TextField()
-    is_read = models.BooleanField(default=False)
     is_image = models.BooleanField(default=False)
     image = models.ImageField(upload_to="chat_images/", blank=True, null=True)
     image_url = models.URLField(null=True, blank=True)
-    created_at = models.DateTimeField(auto_now_add=True)
+    # Set on instantiation rather than on INSERT, so the write-behind ingestion
+    # path can announce the timestamp before the row is persisted
+    created_at = models.DateTimeField(default=now, editable=False)
     updated_at = models.DateTimeField(auto_now=True)
     original_content = models.TextField(null=True, blank=True)
     edited_at = models.DateTimeField(null=True, blank=True)
+    conversation_key = models.CharField(max_length=41, editable=False)
+
+    objects = MessageQuerySet.as_manager()
+
+    def save(self, *args, **kwargs):
+        if self.pk is None and ids.worker_id() is not None:
+            self.pk = ids.next_message_id()
+            kwargs['force_insert'] = True
+        if not self.conversation_key:
+            self.conversation_key = conversation_key_for(self.sender_id, self.receiver_id)
+        super().save(*args, **kwargs)
 
     def edit_message(self, new_content):
         if not self.original_content:
@@ -27,20 +57,176 @@ class Message(models.Model):
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Conversation history and last-message lookups (scanned backwards)
+            models.Index(
+                fields=['conversation_key', 'created_at', 'id'],
+                name='message_conversation_idx',
+            ),
+            # Unread counts: messages past a (receiver, sender) read watermark
+            models.Index(
+                fields=['receiver', 'sender', 'id'],
+                name='message_unread_idx',
+            ),
+            # Delta sync: everything a user sent or received since a watermark
+            models.Index(
+                fields=['receiver', 'updated_at', 'id'],
+                name='message_receiver_sync_idx',
+            ),
+            models.Index(
+                fields=['sender', 'updated_at', 'id'],
+                name='message_sender_sync_idx',
+            ),
+        ]
 
     def __str__(self):
         status = " (edited)" if self.edited_at else ""
         return f"{self.sender.username} -> {self.receiver.username}: {self.content}{status}"
 
+class ContactQuerySet(models.QuerySet):
+    def with_read_state(self):
+        """Annotate `last_message_is_read`, the read state of the last message."""
+        return self.annotate(last_message_is_read=Contact.has_read(
+            models.OuterRef('last_message_id'),
+            receiver=models.OuterRef('last_message__receiver_id'),
+            sender=models.OuterRef('last_message__sender_id'),
+        ))
+
+
 class Contact(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='contacts')
     contact = models.ForeignKey(User, on_delete=models.CASCADE, related_name='contacted_by')
     created_at = models.DateTimeField(auto_now_add=True)
     last_message = models.ForeignKey(Message, on_delete=models.SET_NULL, null=True, blank=True)
+    unread_count = models.PositiveIntegerField(default=0)
+    # `user` has read every message from `contact` with an id up to this one
+    last_read_message_id = models.BigIntegerField(default=0)
+    # When the watermark last moved, for delta sync
+    read_at = models.DateTimeField(null=True, blank=True)
+
+    objects = ContactQuerySet.as_manager()
 
     class Meta:
         unique_together = ['user', 'contact']
 
+    @classmethod
+    def record_message(cls, message):
+        """Point both sides at the new last message and bump the receiver's unread counter."""
+        return cls.record_messages([message])
+
+    @classmethod
+    def record_messages(cls, messages):
+        """
+        Apply a batch of new messages with one UPDATE per conversation: both
+        sides point at the newest message and each receiver's counter grows by
+        the number of messages they were sent past their read watermark.
+        Under write-behind a receipt can arrive before the message is stored,
+        and a message already read must not count as unread.
+        """
+        conversations = {}
+        for message in messages:
+            latest, unread = conversations.setdefault(message.conversation_key, [message, defaultdict(list)])
+            if message.id > latest.id:
+                conversations[message.conversation_key][0] = message
+            unread[message.receiver_id].append(message.id)
+
+        updated = 0
+        for latest, unread in conversations.values():
+            updated += cls.objects.filter(
+                models.Q(user_id=latest.sender_id, contact_id=latest.receiver_id) |
+                models.Q(user_id=latest.receiver_id, contact_id=latest.sender_id)
+            ).update(
+                last_message=latest,
+                unread_count=models.Case(
+                    *(
+                        models.When(user_id=receiver_id, then=models.F('unread_count') + cls.count_unread(message_ids))
+                        for receiver_id, message_ids in unread.items()
+                    ),
+                    default=models.F('unread_count'),
+                    output_field=models.PositiveIntegerField(),
+                ),
+            )
+        return updated
+
+    @staticmethod
+    def count_unread(message_ids):
+        """Expression: how many of `message_ids` lie past the row's read watermark."""
+        message_ids = sorted(message_ids)
+        return models.Case(
+            *(
+                models.When(last_read_message_id__lt=message_id, then=len(message_ids) - position)
+                for position, message_id in enumerate(message_ids)
+            ),
+            default=0,
+            output_field=models.PositiveIntegerField(),
+        )
+
+    @classmethod
+    def mark_conversation_read(cls, user_id, contact_id, up_to=None):
+        """
+        Move `user_id`'s read watermark in the conversation with `contact_id`
+        to message `up_to` (default, and at most: the last message) and
+        recount what is still unread after it, in one single-row UPDATE.
+        The watermark never moves backwards. Returns the new watermark, or
+        None if it did not move.
+
+        Under CHAT_WRITE_BEHIND the last stored message trails delivery, so
+        `up_to` may name any id generated so far (ids are time-ordered);
+        record_messages() then leaves messages at or below it out of the
+        unread count when they are stored.
+        """
+        contact = cls.objects.filter(user_id=user_id, contact_id=contact_id)
+        current = contact.values_list('last_message_id', 'last_read_message_id').first()
+        if current is None:
+            return None
+        last_message_id, last_read_message_id = current[0] or 0, current[1]
+        ceiling = last_message_id
+        if settings.CHAT_WRITE_BEHIND and up_to is not None:
+            # Allow a second for ids that borrowed a later millisecond
+            ceiling = max(ceiling, ids.max_id_at(int(time.time() * 1000) + 1000))
+        watermark = last_message_id if up_to is None else min(int(up_to), ceiling)
+        if watermark <= last_read_message_id:
+            return None
+
+        updated = contact.filter(last_read_message_id__lt=watermark).update(
+            last_read_message_id=watermark,
+            unread_count=cls.unread_count_subquery(watermark),
+            read_at=now(),
+        )
+        return watermark if updated else None
+
+    @classmethod
+    def unread_count_subquery(cls, watermark=None):
+        """
+        Source-of-truth unread count for each Contact row: messages from the
+        contact past `watermark` (default: the row's own). For annotations,
+        reconciliation and UPDATEs that move the watermark.
+        """
+        if watermark is None:
+            watermark = models.OuterRef('last_read_message_id')
+        return Coalesce(
+            models.Subquery(
+                Message.objects.filter(
+                    sender=models.OuterRef('contact'),
+                    receiver=models.OuterRef('user'),
+                    id__gt=watermark,
+                ).order_by().values('receiver').annotate(count=models.Count('id')).values('count')
+            ),
+            0,
+        )
+
+    @classmethod
+    def has_read(cls, message_id, receiver=None, sender=None):
+        """
+        Whether `receiver` has read `message_id` from `sender` (expressions;
+        by default the outer message's own columns), for annotations.
+        """
+        return models.Exists(cls.objects.filter(
+            user_id=receiver if receiver is not None else models.OuterRef('receiver_id'),
+            contact_id=sender if sender is not None else models.OuterRef('sender_id'),
+            last_read_message_id__gte=message_id,
+        ))
+
     def __str__(self):
         return f"{self.user.username} -> {self.contact.username}"
 
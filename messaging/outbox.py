@@ -0,0 +1,111 @@
+# messaging/outbox.py
+import asyncio
+import collections
+import logging
+
+from . import instrumentation, metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox:
+    """
+    Bounded queue of the frames waiting to go out on one websocket.
+
+    Handlers put() frames and return at once; a background task hands
+    everything queued to `send(frames)`, waiting `window` seconds after the
+    first frame so that a burst goes out together. While a send is in
+    progress, frames pile up here instead, within these limits:
+
+    - a frame with a `key` replaces the queued frame with the same key
+      (the newer state wins, e.g. presence of one user);
+    - at `limit` queued frames, `droppable` ones (typing) are discarded:
+      a new one right away, queued ones oldest first to make room;
+    - when only undroppable frames are left, put() returns False once and
+      the outbox stops accepting frames. The connection should be closed;
+      the client catches up through delta sync after reconnecting.
+
+    The limits only bite when `send` waits for the client, i.e. on servers
+    whose ASGI send() waits for the socket to drain. Daphne's does not: it
+    writes into Twisted's transport buffer and returns at once, so the queue
+    here stays short and a stalled client's frames collect, unbounded, in
+    that buffer instead. Under Daphne this bounds nothing; it batches.
+    """
+
+    def __init__(self, send, window=0, limit=256):
+        self.send = send
+        self.window = window
+        self.limit = limit
+        self.closed = False
+        self._frames = collections.deque()
+        self._keyed = {}
+        self._ready = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self._frames)
+
+    def put(self, payload, key=None, droppable=False):
+        """Queue a frame; False when the queue overflowed and the outbox was closed."""
+        if self.closed:
+            return True
+        if key is not None and key in self._keyed:
+            self._keyed[key][1] = payload
+            metrics.outbox_events.labels('merged').inc()
+            return True
+        if len(self._frames) >= self.limit:
+            if droppable:
+                # The new frame is the least valuable one
+                metrics.outbox_events.labels('dropped').inc()
+                return True
+            if not self._drop_oldest():
+                self.close()
+                metrics.outbox_events.labels('overflow').inc()
+                return False
+
+        entry = [key, payload, droppable]
+        self._frames.append(entry)
+        if key is not None:
+            self._keyed[key] = entry
+        self._ready.set()
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        return True
+
+    def close(self):
+        """Discard queued frames and stop sending."""
+        self.closed = True
+        self._frames.clear()
+        self._keyed.clear()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _drop_oldest(self):
+        for entry in self._frames:
+            if entry[2]:
+                self._frames.remove(entry)
+                if entry[0] is not None:
+                    del self._keyed[entry[0]]
+                metrics.outbox_events.labels('dropped').inc()
+                return True
+        return False
+
+    def _take(self):
+        frames = [payload for _, payload, _ in self._frames]
+        self._frames.clear()
+        self._keyed.clear()
+        self._ready.clear()
+        return frames
+
+    async def _run(self):
+        # Started from inside a frame handler; sends are not part of that frame
+        instrumentation.detach()
+        while True:
+            await self._ready.wait()
+            if self.window > 0:
+                await asyncio.sleep(self.window)
+            try:
+                await self.send(self._take())
+            except Exception:
+                logger.exception("Sending queued frames failed")
@@ -0,0 +1,271 @@
+# messaging/pagination.py
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset pagination over (created_at, id) for conversation history.
+
+    Pages are addressed by opaque cursors instead of offsets, so fetching a page
+    costs the same at any depth and stays stable while new messages are inserted.
+
+    - no cursor: the newest `limit` messages
+    - `before=<cursor>`: the `limit` messages immediately older than the cursor
+    - `after=<cursor>`: the `limit` messages immediately newer than the cursor;
+      while there are none yet, the response hands the same cursor back to
+      poll with
+
+    `before` and `after` together are rejected. Results are always returned
+    oldest first. Pages may hold model instances
+    or `.values()` rows that include `created_at` and `id`.
+    """
+    page_size = 50
+    max_page_size = 200
+    before_query_param = 'before'
+    after_query_param = 'after'
+    limit_query_param = 'limit'
+    invalid_cursor_message = 'Invalid cursor'
+    both_cursors_message = 'Pass either before or after, not both'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.limit = self.get_limit(request)
+        if request.query_params.get(self.before_query_param) and request.query_params.get(self.after_query_param):
+            raise ValidationError({'detail': self.both_cursors_message})
+        before = self.decode_cursor(request.query_params.get(self.before_query_param))
+        after = self.decode_cursor(request.query_params.get(self.after_query_param))
+        self.after_cursor = request.query_params.get(self.after_query_param) if after is not None else None
+
+        if after is not None:
+            # Walk forwards from the cursor
+            rows = list(
+                queryset.filter(self.newer_than(after))
+                .order_by('created_at', 'id')[:self.limit + 1]
+            )
+            self.has_newer = len(rows) > self.limit
+            self.has_older = True
+            page = rows[:self.limit]
+        else:
+            # Walk backwards from the cursor (or from the newest message)
+            if before is not None:
+                queryset = queryset.filter(self.older_than(before))
+            rows = list(queryset.order_by('-created_at', '-id')[:self.limit + 1])
+            self.has_older = len(rows) > self.limit
+            self.has_newer = before is not None
+            page = rows[:self.limit]
+            page.reverse()
+
+        self.page = page
+        return page
+
+    def get_paginated_response(self, data):
+        before = after = None
+        if self.page:
+            if self.has_older:
+                before = self.encode_cursor(self.page[0])
+            if self.has_newer:
+                after = self.encode_cursor(self.page[-1])
+        elif self.after_cursor is not None:
+            # Nothing newer yet: the client keeps polling from where it is
+            after = self.after_cursor
+        return Response(OrderedDict([
+            ('before', before),
+            ('after', after),
+            ('results', data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        cursor = {'type': 'string', 'nullable': True}
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'before': cursor,
+                'after': cursor,
+                'results': schema,
+            },
+        }
+
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params[self.limit_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if limit <= 0:
+            return self.page_size
+        return min(limit, self.max_page_size)
+
+    @staticmethod
+    def older_than(position):
+        created_at, pk = position
+        return Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk)
+
+    @staticmethod
+    def newer_than(position):
+        created_at, pk = position
+        return Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk)
+
+    def encode_cursor(self, message):
+        if isinstance(message, dict):
+            created_at, pk = message['created_at'], message['id']
+        else:
+            created_at, pk = message.created_at, message.id
+        raw = f"{created_at.isoformat()}|{pk}"
+        return urlsafe_b64encode(raw.encode('ascii')).decode('ascii')
+
+    def decode_cursor(self, encoded):
+        if not encoded:
+            return None
+        try:
+            raw = urlsafe_b64decode(encoded.encode('ascii')).decode('ascii')
+            created_at, pk = raw.rsplit('|', 1)
+            position = (parse_datetime(created_at), int(pk))
+        except (TypeError, ValueError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+        if position[0] is None:
+            raise NotFound(self.invalid_cursor_message)
+        return position
+
+
+class SearchPagination(KeysetPagination):
+    """
+    Offset pagination for ranked search results, whose order has no stable
+    key to resume from. `next` is the offset of the following page, or null.
+    """
+    page_size = 20
+    max_page_size = 50
+    offset_query_param = 'offset'
+
+    def get_window(self, request):
+        """(limit, offset) requested; fetch one extra row to learn if there is a next page."""
+        self.limit = self.get_limit(request)
+        try:
+            self.offset = max(int(request.query_params[self.offset_query_param]), 0)
+        except (KeyError, ValueError):
+            self.offset = 0
+        return self.limit, self.offset
+
+    def paginate_ids(self, ids):
+        self.has_next = len(ids) > self.limit
+        return ids[:self.limit]
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.offset + self.limit if self.has_next else None),
+            ('results', data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'integer', 'nullable': True},
+                'results': schema,
+            },
+        }
+
+
+class SyncPagination(KeysetPagination):
+    """
+    Keyset pagination over (updated_at, id) for catching up on changes:
+    new and edited messages, plus read watermarks that moved (`read`).
+
+    - no cursor: every message, from the oldest change
+    - `since=<cursor>`: the changes after the cursor
+
+    `more` is true while further pages are waiting; fetch them right away.
+    The cursor of the last page is "settled": syncing from it again re-reads
+    the final settings.CHAT_SYNC_OVERLAP_SECONDS of changes. `updated_at` is
+    stamped before its transaction commits, so a change can become visible
+    after a later one was already synced; the overlap catches it. Clients
+    apply results by id, so a repeated row is harmless.
+    """
+    page_size = 200
+    max_page_size = 1000
+    since_query_param = 'since'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.limit = self.get_limit(request)
+        self.since = self.decode_cursor(request.query_params.get(self.since_query_param))
+        # Lower bound for other changes reported alongside the page
+        self.changed_since = None
+
+        if self.since is not None:
+            updated_at, pk, settled = self.since
+            self.changed_since = updated_at
+            if settled and settings.CHAT_SYNC_OVERLAP_SECONDS > 0:
+                overlap = timedelta(seconds=settings.CHAT_SYNC_OVERLAP_SECONDS)
+                self.changed_since = updated_at - overlap
+                queryset = queryset.filter(updated_at__gte=self.changed_since)
+            else:
+                queryset = queryset.filter(
+                    Q(updated_at__gt=updated_at) | Q(updated_at=updated_at, id__gt=pk)
+                )
+        rows = list(queryset.order_by('updated_at', 'id')[:self.limit + 1])
+        self.more = len(rows) > self.limit
+        self.page = rows[:self.limit]
+        return self.page
+
+    def get_paginated_response(self, data, read=()):
+        if self.page:
+            last = self.page[-1]
+            cursor = self.encode_cursor((last['updated_at'], last['id'], not self.more))
+        elif self.since is not None:
+            cursor = self.encode_cursor(self.since)
+        else:
+            cursor = None
+        return Response(OrderedDict([
+            ('cursor', cursor),
+            ('more', self.more),
+            ('results', data),
+            ('read', list(read)),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['more', 'results'],
+            'properties': {
+                'cursor': {'type': 'string', 'nullable': True},
+                'more': {'type': 'boolean'},
+                'results': schema,
+                'read': {
+                    'type': 'array',
+                    'items': {
+                        'type': 'object',
+                        'properties': {
+                            'reader_id': {'type': 'integer'},
+                            'contact_id': {'type': 'integer'},
+                            'last_read_message_id': {'type': 'integer'},
+                        },
+                    },
+                },
+            },
+        }
+
+    def encode_cursor(self, position):
+        updated_at, pk, settled = position
+        raw = f"{updated_at.isoformat()}|{pk}|{int(settled)}"
+        return urlsafe_b64encode(raw.encode('ascii')).decode('ascii')
+
+    def decode_cursor(self, encoded):
+        if not encoded:
+            return None
+        try:
+            raw = urlsafe_b64decode(encoded.encode('ascii')).decode('ascii')
+            updated_at, pk, settled = raw.split('|')
+            position = (parse_datetime(updated_at), int(pk), settled == '1')
+        except (TypeError, ValueError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+        if position[0] is None:
+            raise NotFound(self.invalid_cursor_message)
+        return position
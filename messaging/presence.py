@@ -0,0 +1,331 @@
+# messaging/presence.py
+import asyncio
+import logging
+import math
+import time
+import weakref
+
+from django.conf import settings
+
+from . import metrics
+from .db import database_sync_to_async
+
+logger = logging.getLogger(__name__)
+
+# user_id -> task waiting out the grace window before announcing "offline"
+_pending_offline = {}
+
+
+async def group_send_many(channel_layer, groups, message):
+    """
+    Send the same event to many groups, PRESENCE_FANOUT_BATCH_SIZE at a time.
+
+    Sends within a batch run concurrently; one failing group is logged and
+    does not stop delivery to the others.
+    """
+    groups = list(groups)
+    batch_size = max(1, settings.PRESENCE_FANOUT_BATCH_SIZE)
+    for start in range(0, len(groups), batch_size):
+        batch = groups[start:start + batch_size]
+        results = await asyncio.gather(
+            *(metrics.observe_layer('group_send', channel_layer.group_send(group, message)) for group in batch),
+            return_exceptions=True
+        )
+        for group, result in zip(batch, results):
+            if isinstance(result, Exception):
+                logger.warning("group_send to %s failed: %s", group, result)
+
+
+async def schedule_offline(user_id, callback):
+    """
+    Run `callback` once the user has stayed disconnected for the grace window.
+
+    A reconnect inside the window calls cancel_offline() and the user never
+    appears to have left. The timer lives in this process, so a reconnect
+    through another worker does not cancel it; `callback` has to check
+    registry.is_online(), which counts connections on every worker. With no
+    grace window the callback runs inline.
+    """
+    cancel_offline(user_id)
+    delay = settings.PRESENCE_GRACE_SECONDS
+    if delay <= 0:
+        await callback()
+        return
+    _pending_offline[user_id] = asyncio.ensure_future(
+        _offline_after(user_id, callback, delay)
+    )
+
+
+def cancel_offline(user_id):
+    """Cancel a pending offline transition. Returns True if one was pending."""
+    task = _pending_offline.pop(user_id, None)
+    if task is None:
+        return False
+    task.cancel()
+    return True
+
+
+async def _offline_after(user_id, callback, delay):
+    await asyncio.sleep(delay)
+    # Past this point the transition can no longer be cancelled
+    if _pending_offline.get(user_id) is asyncio.current_task():
+        del _pending_offline[user_id]
+    try:
+        await callback()
+    except Exception:
+        logger.exception("Offline transition for user %s failed", user_id)
+
+
+class LocalPresenceStore:
+    """Connection counts of this process only; enough for a single worker."""
+
+    renew_interval = 0
+
+    def __init__(self):
+        self._counts = {}
+
+    async def add(self, user_id, channel_name):
+        """Count a connection. Returns True if it is the user's first one."""
+        self._counts[user_id] = self._counts.get(user_id, 0) + 1
+        return self._counts[user_id] == 1
+
+    async def remove(self, user_id, channel_name):
+        """Uncount a connection. Returns True if the user has none left."""
+        count = self._counts.pop(user_id, 0) - 1
+        if count > 0:
+            self._counts[user_id] = count
+            return False
+        return True
+
+    async def count(self, user_id):
+        return self._counts.get(user_id, 0)
+
+    async def renew(self, connections):
+        pass
+
+
+class RedisPresenceStore:
+    """
+    Connection counts shared by every worker process through Redis.
+
+    Each user has a sorted set of their connections' channel names, scored
+    by lease expiry. Workers renew the leases of their own connections
+    every `lease` / 3 seconds, so the connections of a worker that died
+    without closing them lapse after `lease` seconds instead of keeping
+    their users online for good.
+    """
+
+    prefix = 'presence:'
+
+    def __init__(self, url, lease, client_factory=None):
+        self.url = url
+        self.lease = lease
+        self.renew_interval = lease / 3
+        if client_factory is None:
+            import redis.asyncio
+            client_factory = redis.asyncio.from_url
+        self._client_factory = client_factory
+        # Redis connections belong to the event loop that opened them
+        self._clients = weakref.WeakKeyDictionary()
+
+    def _client(self):
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = self._clients[loop] = self._client_factory(self.url)
+        return client
+
+    def _key(self, user_id):
+        return f"{self.prefix}{user_id}"
+
+    async def add(self, user_id, channel_name):
+        """Count a connection. Returns True if it is the user's first one on any worker."""
+        key, now = self._key(user_id), time.time()
+        async with self._client().pipeline(transaction=True) as pipe:
+            pipe.zremrangebyscore(key, '-inf', now)
+            pipe.zadd(key, {channel_name: now + self.lease})
+            pipe.zcard(key)
+            pipe.expire(key, math.ceil(self.lease))
+            _, _, count, _ = await pipe.execute()
+        return count == 1
+
+    async def remove(self, user_id, channel_name):
+        """Uncount a connection. Returns True if the user has none left on any worker."""
+        key, now = self._key(user_id), time.time()
+        async with self._client().pipeline(transaction=True) as pipe:
+            pipe.zrem(key, channel_name)
+            pipe.zremrangebyscore(key, '-inf', now)
+            pipe.zcard(key)
+            _, _, count = await pipe.execute()
+        return count == 0
+
+    async def count(self, user_id):
+        return await self._client().zcount(self._key(user_id), time.time(), '+inf')
+
+    async def renew(self, connections):
+        """Extend the leases of (user_id, channel_name) pairs held by this worker."""
+        expires = time.time() + self.lease
+        async with self._client().pipeline(transaction=False) as pipe:
+            for user_id, channel_name in connections:
+                # xx: a connection removed meanwhile must not come back
+                pipe.zadd(self._key(user_id), {channel_name: expires}, xx=True)
+                pipe.expire(self._key(user_id), math.ceil(self.lease))
+            await pipe.execute()
+
+
+def make_store():
+    """The connection store selected by PRESENCE_STORE."""
+    if settings.PRESENCE_STORE == 'redis':
+        return RedisPresenceStore(settings.REDIS_URL, settings.PRESENCE_LEASE_SECONDS)
+    return LocalPresenceStore()
+
+
+class PresenceRegistry:
+    """
+    Record of which users have live websocket connections.
+
+    Users are online while they hold at least one connection on any worker,
+    so closing one of several tabs changes nothing. The count is kept by a
+    connection store (see make_store()); this process's own connections are
+    tracked here too. Connections that stop heartbeating for
+    PRESENCE_CONNECTION_TTL seconds are closed and dropped. Online/offline
+    transitions and heartbeats are collected in memory and written to
+    UserStatus in one bulk upsert every PRESENCE_FLUSH_INTERVAL seconds.
+    """
+
+    def __init__(self, store=None):
+        self._store = store
+        # user_id -> {channel_name: (last heartbeat, on_lost callback, close callback)}
+        self._connections = {}
+        # user_id -> is_online, waiting to be flushed to UserStatus
+        self._dirty = {}
+        self._task = None
+
+    @property
+    def store(self):
+        if self._store is None:
+            self._store = make_store()
+        return self._store
+
+    async def connect(self, user_id, channel_name, on_lost=None, close=None):
+        """
+        Register a connection. Returns True if it is the user's first one.
+
+        `on_lost` is scheduled like a disconnect and `close` is awaited when
+        the connection misses its heartbeats.
+        """
+        self._connections.setdefault(user_id, {})[channel_name] = (time.monotonic(), on_lost, close)
+        first = await self.store.add(user_id, channel_name)
+        self._ensure_flusher()
+        return first
+
+    async def disconnect(self, user_id, channel_name):
+        """Forget a connection. Returns True if the user has none left."""
+        connections = self._connections.get(user_id)
+        if not connections or channel_name not in connections:
+            # Never registered, or already dropped by expire()
+            return False
+        del connections[channel_name]
+        if not connections:
+            del self._connections[user_id]
+        return await self.store.remove(user_id, channel_name)
+
+    def heartbeat(self, user_id, channel_name):
+        connections = self._connections.get(user_id)
+        if connections and channel_name in connections:
+            connections[channel_name] = (time.monotonic(), *connections[channel_name][1:])
+            self._dirty.setdefault(user_id, True)
+            self._ensure_flusher()
+
+    async def is_online(self, user_id):
+        return await self.store.count(user_id) > 0
+
+    async def connection_count(self, user_id):
+        return await self.store.count(user_id)
+
+    async def set_online(self, user_id, is_online):
+        """Queue a UserStatus write; with no flush interval it is written immediately."""
+        self._dirty[user_id] = is_online
+        if settings.PRESENCE_FLUSH_INTERVAL <= 0:
+            await self.flush()
+        else:
+            self._ensure_flusher()
+
+    async def expire(self):
+        """Close connections that missed their heartbeats and take their users offline."""
+        ttl = settings.PRESENCE_CONNECTION_TTL
+        if ttl <= 0:
+            return
+        cutoff = time.monotonic() - ttl
+        for user_id, connections in list(self._connections.items()):
+            for channel_name, (seen, on_lost, close) in list(connections.items()):
+                if seen >= cutoff:
+                    continue
+                logger.info("Presence: dropping stale connection %s for user %s", channel_name, user_id)
+                if close is not None:
+                    try:
+                        await close()
+                    except Exception:
+                        logger.exception("Presence: closing stale connection %s failed", channel_name)
+                if await self.disconnect(user_id, channel_name) and on_lost is not None:
+                    await schedule_offline(user_id, on_lost)
+
+    async def renew(self):
+        """Keep this process's connections alive in the store."""
+        connections = [
+            (user_id, channel_name)
+            for user_id, channels in self._connections.items()
+            for channel_name in channels
+        ]
+        if not connections:
+            return
+        try:
+            await self.store.renew(connections)
+        except Exception:
+            logger.exception("Presence: renewing %d connections failed", len(connections))
+
+    async def flush(self):
+        """Write all pending transitions and heartbeats in one bulk upsert."""
+        if not self._dirty:
+            return
+        pending, self._dirty = self._dirty, {}
+        try:
+            await database_sync_to_async(self._write)(pending)
+        except Exception:
+            logger.exception("Presence: flushing %d statuses failed", len(pending))
+            # Keep anything that changed again while we were writing
+            self._dirty = {**pending, **self._dirty}
+
+    @staticmethod
+    def _write(pending):
+        from .models import UserStatus
+
+        UserStatus.objects.bulk_create(
+            [
+                UserStatus(user_id=user_id, is_online=is_online)
+                for user_id, is_online in pending.items()
+            ],
+            update_conflicts=True,
+            unique_fields=['user'],
+            update_fields=['is_online', 'last_seen'],
+        )
+
+    def _interval(self):
+        intervals = [i for i in (settings.PRESENCE_FLUSH_INTERVAL, self.store.renew_interval) if i > 0]
+        return min(intervals, default=0)
+
+    def _ensure_flusher(self):
+        if self._interval() <= 0:
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while self._connections or self._dirty:
+            await asyncio.sleep(self._interval())
+            await self.expire()
+            await self.renew()
+            await self.flush()
+
+
+registry = PresenceRegistry()
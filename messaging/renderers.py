@@ -0,0 +1,48 @@
+# messaging/renderers.py
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+from . import instrumentation
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class InstrumentedJSONRenderer(JSONRenderer):
+    """JSONRenderer that counts encoding as serialization time of the current request."""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        with instrumentation.serializing():
+            return super().render(data, accepted_media_type, renderer_context)
+
+
+class FastJSONRenderer(InstrumentedJSONRenderer):
+    """
+    Encodes compact responses with orjson when it is installed, byte for byte
+    like DRF's JSONRenderer: UTF-8 output, U+2028/U+2029 escaped, and anything
+    orjson doesn't know natively (including datetimes, whose format differs)
+    handed to DRF's JSONEncoder. Indented output and the settings orjson
+    can't mimic go through the stock renderer.
+    """
+    _default = JSONEncoder().default
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if (
+            orjson is None or data is None
+            or self.encoder_class is not JSONEncoder
+            or self.ensure_ascii
+            or not self.compact
+            or not self.strict
+            or self.get_indent(accepted_media_type or '', renderer_context or {})
+        ):
+            return super().render(data, accepted_media_type, renderer_context)
+
+        with instrumentation.serializing():
+            try:
+                ret = orjson.dumps(data, default=self._default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+            except TypeError:
+                # e.g. integers beyond 64 bits
+                return super().render(data, accepted_media_type, renderer_context)
+            return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
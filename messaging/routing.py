@@ -9,4 +9,4 @@ logger.info("Registering WebSocket URL patterns")
 websocket_urlpatterns = [
     re_path(r'^ws/chat/$', ChatConsumer.as_asgi()),
 ]
-logger.info(f"WebSocket patterns registered: {websocket_urlpatterns}")
\ No newline at end of file
+logger.info("WebSocket patterns registered: %s", websocket_urlpatterns)
\ No newline at end of file
@@ -0,0 +1,171 @@
+# messaging/search.py
+"""
+Full-text search over message content.
+
+- SQLite: a contentless FTS5 table, `messaging_message_fts`, whose rowid is
+  the message id. Triggers on messaging_message keep it in sync. Besides the
+  content it indexes the participants as `u<id>` tokens, so the full-text
+  index itself restricts matches to the caller's conversations.
+- PostgreSQL: a generated `search_vector` tsvector column with a GIN index.
+  Scoping uses the sender and receiver indexes.
+- Other backends: a case-insensitive `icontains` scan, newest first.
+
+Neither index stems words. Every term must match. A trailing `*` makes the
+last term match as a prefix too; this is opt-in because expanding a prefix
+of a common word costs more than the rest of the query. Results are
+ordered by relevance, then newest first.
+
+SQLite drops a table's triggers when Django rebuilds that table in a
+migration. Any migration that rebuilds messaging_message must call
+install_triggers() afterwards.
+"""
+import re
+
+from django.db import connection
+
+from .models import Message, conversation_key_for
+
+MAX_TERMS = 8
+
+_TERMS = re.compile(r'[^\W_]+')
+
+FTS_TABLE = 'messaging_message_fts'
+
+_PARTICIPANTS = "'u' || {row}.sender_id || ' u' || {row}.receiver_id"
+
+_SQLITE_TRIGGERS = {
+    'messaging_message_fts_insert': f"""
+        CREATE TRIGGER IF NOT EXISTS messaging_message_fts_insert
+        AFTER INSERT ON messaging_message BEGIN
+            INSERT INTO {FTS_TABLE} (rowid, content, participants)
+            VALUES (new.id, new.content, {_PARTICIPANTS.format(row='new')});
+        END
+    """,
+    'messaging_message_fts_delete': f"""
+        CREATE TRIGGER IF NOT EXISTS messaging_message_fts_delete
+        AFTER DELETE ON messaging_message BEGIN
+            INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, content, participants)
+            VALUES ('delete', old.id, old.content, {_PARTICIPANTS.format(row='old')});
+        END
+    """,
+    'messaging_message_fts_update': f"""
+        CREATE TRIGGER IF NOT EXISTS messaging_message_fts_update
+        AFTER UPDATE OF content, sender_id, receiver_id ON messaging_message BEGIN
+            INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, content, participants)
+            VALUES ('delete', old.id, old.content, {_PARTICIPANTS.format(row='old')});
+            INSERT INTO {FTS_TABLE} (rowid, content, participants)
+            VALUES (new.id, new.content, {_PARTICIPANTS.format(row='new')});
+        END
+    """,
+}
+
+
+def install(schema_editor):
+    """Create and backfill the search index for the current backend."""
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+            "content, participants, content='', "
+            "tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+        )
+        schema_editor.execute(
+            f"INSERT INTO {FTS_TABLE} (rowid, content, participants) "
+            f"SELECT id, content, {_PARTICIPANTS.format(row='messaging_message')} FROM messaging_message"
+        )
+        install_triggers(schema_editor)
+    elif vendor == 'postgresql':
+        # Rewrites the table once to compute the column for existing rows
+        schema_editor.execute(
+            "ALTER TABLE messaging_message ADD COLUMN search_vector tsvector "
+            "GENERATED ALWAYS AS (to_tsvector('simple', content)) STORED"
+        )
+        schema_editor.execute(
+            "CREATE INDEX message_search_idx ON messaging_message USING gin (search_vector)"
+        )
+
+
+def uninstall(schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        for name in _SQLITE_TRIGGERS:
+            schema_editor.execute(f"DROP TRIGGER IF EXISTS {name}")
+        schema_editor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+    elif vendor == 'postgresql':
+        schema_editor.execute("ALTER TABLE messaging_message DROP COLUMN IF EXISTS search_vector")
+
+
+def install_triggers(schema_editor):
+    """(Re)create the SQLite triggers that keep the FTS table in sync."""
+    if schema_editor.connection.vendor == 'sqlite':
+        for sql in _SQLITE_TRIGGERS.values():
+            schema_editor.execute(sql)
+
+
+def parse_query(query):
+    """
+    (terms, prefix) for a user's query: its words, lowercased, at most
+    MAX_TERMS, and whether it ends with `*`.
+    """
+    terms = _TERMS.findall(query.lower())[:MAX_TERMS]
+    return terms, query.rstrip().endswith('*')
+
+
+def search_message_ids(user_id, terms, contact_id=None, limit=20, offset=0, prefix=False):
+    """
+    Ids of the messages in `user_id`'s conversations (or only the one with
+    `contact_id`) that match all `terms`, best match first. With `prefix`
+    the last term matches as a prefix.
+    """
+    if not terms:
+        return []
+    if connection.vendor == 'sqlite':
+        search = _search_sqlite
+    elif connection.vendor == 'postgresql':
+        search = _search_postgresql
+    else:
+        search = _search_fallback
+    return search(user_id, terms, contact_id, limit, offset, prefix)
+
+
+def _search_sqlite(user_id, terms, contact_id, limit, offset, prefix):
+    # Terms are plain words, so quoting them is enough to escape FTS5 syntax
+    content = ' '.join(f'"{term}"' for term in terms) + ('*' if prefix else '')
+    participants = f'"u{int(user_id)}"'
+    if contact_id is not None:
+        participants += f' "u{int(contact_id)}"'
+    match = f'content : ({content}) AND participants : ({participants})'
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s "
+            f"ORDER BY bm25({FTS_TABLE}, 1.0, 0.0), rowid DESC LIMIT %s OFFSET %s",
+            [match, limit, offset],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def _search_postgresql(user_id, terms, contact_id, limit, offset, prefix):
+    tsquery = ' & '.join(f"'{term}'" for term in terms) + (':*' if prefix else '')
+    if contact_id is not None:
+        scope, params = "conversation_key = %s", [conversation_key_for(user_id, contact_id)]
+    else:
+        scope, params = "(sender_id = %s OR receiver_id = %s)", [user_id, user_id]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT id FROM messaging_message, to_tsquery('simple', %s) query "
+            f"WHERE search_vector @@ query AND {scope} "
+            "ORDER BY ts_rank(search_vector, query) DESC, id DESC LIMIT %s OFFSET %s",
+            [tsquery, *params, limit, offset],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def _search_fallback(user_id, terms, contact_id, limit, offset, prefix):
+    # Substring matching, so every term already matches as a prefix
+    if contact_id is not None:
+        queryset = Message.objects.filter(conversation_key=conversation_key_for(user_id, contact_id))
+    else:
+        queryset = Message.objects.filter(sender_id=user_id) | Message.objects.filter(receiver_id=user_id)
+    for term in terms:
+        queryset = queryset.filter(content__icontains=term)
+    return list(queryset.order_by('-id').values_list('id', flat=True)[offset:offset + limit])
@@ -0,0 +1,193 @@
+# messaging/seeding.py
+"""
+Deterministic fixture generation for benchmarks, tests and load testing.
+
+Everything is written with bulk inserts in chunks of `chunk_size` rows, so
+memory stays bounded by the chunk size (plus one id per user) no matter how
+many messages are generated.
+"""
+import random
+from datetime import datetime, time as datetime_time, timedelta, timezone as dt_timezone
+from itertools import islice
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import CharField, OuterRef, Subquery, Value
+from django.db.models.functions import Cast, Coalesce, Concat, Greatest, Least
+
+from .ids import MessageIdGenerator
+from .models import Contact, Message, conversation_key_for
+
+User = get_user_model()
+
+WORDS = (
+    "hey", "hi", "ok", "sure", "thanks", "see", "you", "tomorrow", "lunch", "call",
+    "later", "meeting", "sounds", "good", "on", "my", "way", "what", "about", "now",
+    "did", "get", "the", "file", "photo", "weekend", "plans", "running", "late", "lol",
+)
+
+# Worker id for generated history; live generated ids are minted "now", so they never collide with it
+SEED_ID_WORKER = 31
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def create_users(prefix, count, chunk_size=5000):
+    """Create `count` users named <prefix><n>; returns their ids in order."""
+    password = make_password(prefix)
+    ids = []
+    for chunk in chunked(range(count), chunk_size):
+        users = User.objects.bulk_create([
+            User(email=f"{prefix}{n}@seed.local", username=f"{prefix}{n}", password=password)
+            for n in chunk
+        ])
+        ids.extend(user.id for user in users)
+    return ids
+
+
+def connect_users(pairs, chunk_size=5000):
+    """Create two-way Contact rows for each (user_id, user_id) pair."""
+    for chunk in chunked(pairs, chunk_size):
+        Contact.objects.bulk_create(
+            [Contact(user_id=a, contact_id=b) for a, b in chunk] +
+            [Contact(user_id=b, contact_id=a) for a, b in chunk]
+        )
+
+
+def create_messages(specs, start, interval=timedelta(seconds=1), chunk_size=5000, worker_id=SEED_ID_WORKER):
+    """
+    Insert messages from an iterable of (sender_id, receiver_id, content)
+    tuples, spaced `interval` apart from `start`. Ids are derived from the
+    timestamps, so they sort like created_at; two datasets covering the same
+    time range need different `worker_id`s. Returns the number of messages.
+    """
+    ids = MessageIdGenerator(worker_id=worker_id)
+    total = 0
+    for chunk in chunked(specs, chunk_size):
+        batch = []
+        for sender_id, receiver_id, content in chunk:
+            created_at = start + interval * total
+            total += 1
+            batch.append(Message(
+                id=ids.next_id(int(created_at.timestamp() * 1000)),
+                sender_id=sender_id,
+                receiver_id=receiver_id,
+                content=content,
+                created_at=created_at,
+                conversation_key=conversation_key_for(sender_id, receiver_id),
+            ))
+        Message.objects.bulk_create(batch)
+
+    # Ids the database assigns later must sort after the generated ones
+    with connection.cursor() as cursor:
+        for sql in connection.ops.sequence_reset_sql(no_style(), [Message]):
+            cursor.execute(sql)
+    return total
+
+
+def refresh_contacts(contacts=None, chunk_size=5000, read_before=None):
+    """
+    Recompute last_message and unread_count of `contacts` (default: all) from
+    the message table, two UPDATEs per chunk of contact rows. With
+    `read_before`, first move each read watermark to the last message of the
+    conversation created before that time.
+    """
+    contacts = Contact.objects.all() if contacts is None else contacts
+    conversation_key = Concat(
+        Cast(Least(OuterRef('user_id'), OuterRef('contact_id')), CharField()),
+        Value(':'),
+        Cast(Greatest(OuterRef('user_id'), OuterRef('contact_id')), CharField()),
+    )
+    latest = Message.objects.filter(
+        conversation_key=conversation_key
+    ).order_by('-created_at', '-id').values('id')[:1]
+    changes = {'last_message_id': Subquery(latest)}
+    if read_before is not None:
+        read = Message.objects.filter(
+            conversation_key=conversation_key, created_at__lt=read_before
+        ).order_by('-created_at', '-id').values('id')[:1]
+        changes['last_read_message_id'] = Coalesce(Subquery(read), 0)
+
+    last_id = 0
+    while True:
+        ids = list(
+            contacts.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:chunk_size]
+        )
+        if not ids:
+            return
+        last_id = ids[-1]
+        # The counter depends on the watermark, which must be written first
+        Contact.objects.filter(id__in=ids).update(**changes)
+        Contact.objects.filter(id__in=ids).update(unread_count=Contact.unread_count_subquery())
+
+
+def seed_dataset(users, messages, contacts_per_user=20, seed=0, prefix='seed',
+                 days=365, end=None, read_ratio=0.9, chunk_size=5000, worker_id=SEED_ID_WORKER, log=None):
+    """
+    Generate a reproducible chat dataset.
+
+    Every user gets about `contacts_per_user` contacts, laid out as a ring
+    with fixed offsets, so the pairs can be regenerated at any time without
+    storing them. Messages go to random pairs in random directions, spread
+    evenly over `days` days before `end` (default: today 00:00 UTC). Every
+    user has read the first `read_ratio` share of that span. Message ids use `worker_id` (see
+    create_messages). Returns a summary dict.
+    """
+    log = log or (lambda message: None)
+    rng = random.Random(seed)
+    end = end or datetime.combine(datetime.now(dt_timezone.utc).date(), datetime_time(), dt_timezone.utc)
+    if end.tzinfo is None:
+        end = end.replace(tzinfo=dt_timezone.utc)
+
+    log(f"Creating {users} users")
+    with transaction.atomic():
+        user_ids = create_users(prefix, users, chunk_size)
+
+    # Distinct offsets below n/2 make every (i, i + offset) pair unique
+    half = max(1, (users - 1) // 2)
+    offsets = rng.sample(range(1, half + 1), min(max(1, contacts_per_user // 2), half))
+
+    def pairs():
+        for index in range(users):
+            for offset in offsets:
+                yield user_ids[index], user_ids[(index + offset) % users]
+
+    log(f"Creating {users * len(offsets) * 2} contacts")
+    with transaction.atomic():
+        connect_users(pairs(), chunk_size)
+
+    def specs():
+        for _ in range(messages):
+            a = rng.randrange(users)
+            b = (a + rng.choice(offsets)) % users
+            if rng.random() < 0.5:
+                a, b = b, a
+            content = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 12)))
+            yield user_ids[a], user_ids[b], content
+
+    log(f"Creating {messages} messages")
+    start = end - timedelta(days=days)
+    interval = timedelta(days=days) / max(1, messages)
+    with transaction.atomic():
+        create_messages(specs(), start, interval, chunk_size, worker_id)
+
+    log("Updating last messages, read watermarks and unread counters")
+    with transaction.atomic():
+        refresh_contacts(
+            Contact.objects.filter(user_id__gte=user_ids[0], user_id__lte=user_ids[-1]),
+            chunk_size,
+            read_before=start + timedelta(days=days) * read_ratio,
+        )
+
+    return {
+        'users': users,
+        'contacts': users * len(offsets) * 2,
+        'messages': messages,
+        'first_user_id': user_ids[0] if user_ids else None,
+    }
@@ -1,14 +1,25 @@
 # messaging/serializers.py
-from rest_framework import serializers
+import logging
+from functools import lru_cache
+
+from django.conf import settings
+from django.utils import timezone
+from rest_framework import ISO_8601, serializers
+from rest_framework.settings import api_settings
+from .instrumentation import InstrumentedSerializerMixin, serializing
 from .models import Message, Contact, UserStatus
 from accounts.serializers import UserSerializer
 from django.contrib.auth import get_user_model
 
 User = get_user_model()
 
-class MessageSerializer(serializers.ModelSerializer):
+logger = logging.getLogger(__name__)
+
+class MessageSerializer(InstrumentedSerializerMixin, serializers.ModelSerializer):
     sender_name = serializers.CharField(source='sender.username', read_only=True)
     sender_avatar = serializers.SerializerMethodField()
+    # Annotated by Message.objects.with_read_state(); new messages are unread
+    is_read = serializers.BooleanField(read_only=True, default=False)
 
     class Meta:
         model = Message
@@ -22,17 +33,20 @@ class MessageSerializer(serializers.ModelSerializer):
             'is_image', 
             'image_url',
             'sender_name',
-            'sender_avatar'
+            'sender_avatar',
+            'edited_at',
+            'updated_at',
+        ]
+        read_only_fields = [
+            'id', 'created_at', 'sender', 'sender_name', 'sender_avatar', 'edited_at', 'updated_at'
         ]
-        read_only_fields = ['id', 'created_at', 'sender', 'sender_name', 'sender_avatar']
 
     def get_sender_avatar(self, obj):
         return obj.sender.avatar.url if hasattr(obj.sender, 'avatar') and obj.sender.avatar else None
 
     def to_representation(self, instance):
-        """Add extra logging for debugging"""
         data = super().to_representation(instance)
-        print(f"Serializing message {instance.id}: {data}")
+        logger.debug("Serialized message %s", instance.id)
         return data
 
     def validate_receiver(self, value):
@@ -56,14 +70,13 @@ class MessageSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError({
                 'content': 'Content cannot be empty'
             })
-        print(f"Validated data: {data}")  # Debug log
+        logger.debug("Validated message fields: %s", sorted(data))
         return data
     
-class ContactSerializer(serializers.ModelSerializer):
+class ContactSerializer(InstrumentedSerializerMixin, serializers.ModelSerializer):
     contact_details = UserSerializer(source='contact', read_only=True)
     last_message = serializers.SerializerMethodField()
     online = serializers.SerializerMethodField()
-    unread_count = serializers.SerializerMethodField()
 
     class Meta:
         model = Contact
@@ -75,6 +88,7 @@ class ContactSerializer(serializers.ModelSerializer):
             'unread_count', 
             'created_at'
         ]
+        read_only_fields = ['unread_count']
 
     def get_last_message(self, obj):
         if obj.last_message:
@@ -82,7 +96,7 @@ class ContactSerializer(serializers.ModelSerializer):
                 'id': obj.last_message.id,
                 'content': obj.last_message.content,
                 'timestamp': obj.last_message.created_at.strftime("%I:%M%p"),
-                'is_read': obj.last_message.is_read,
+                'is_read': getattr(obj, 'last_message_is_read', False),
                 'is_image': obj.last_message.is_image,
                 'image_url': obj.last_message.image_url if obj.last_message.is_image else None
             }
@@ -94,13 +108,6 @@ class ContactSerializer(serializers.ModelSerializer):
         except UserStatus.DoesNotExist:
             return False
 
-    def get_unread_count(self, obj):
-        return Message.objects.filter(
-            sender=obj.contact,
-            receiver=obj.user,
-            is_read=False
-        ).count()
-
 class MessageEditSerializer(serializers.ModelSerializer):
     class Meta:
         model = Message
@@ -130,7 +137,115 @@ class ContactInviteSerializer(serializers.Serializer):
             raise serializers.ValidationError("User with this email does not exist")
         
 
-class UserStatusSerializer(serializers.ModelSerializer):
+class UserStatusSerializer(InstrumentedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = UserStatus
-        fields = ['user', 'is_online']
\ No newline at end of file
+        fields = ['user', 'is_online']
+
+def datetime_formatter():
+    """
+    DRF DateTimeField output as a plain function. For the default ISO 8601
+    format this skips the per-call field machinery.
+    """
+    if api_settings.DATETIME_FORMAT != ISO_8601 or not settings.USE_TZ:
+        return serializers.DateTimeField().to_representation
+    tz = timezone.get_current_timezone()
+
+    def to_representation(value):
+        value = value.astimezone(tz).isoformat()
+        return value[:-6] + 'Z' if value.endswith('+00:00') else value
+    return to_representation
+
+
+def avatar_url_resolver():
+    """Storage URL lookup for avatars, memoized for one response."""
+    return lru_cache(maxsize=None)(User._meta.get_field('avatar').storage.url)
+
+
+class MessageRowSerializer:
+    """
+    Fast path for message lists: builds MessageSerializer's output directly
+    from `.values(*MessageRowSerializer.columns)` rows, skipping model
+    instances and per-field DRF machinery. Output is identical.
+    """
+    columns = (
+        'id', 'content', 'sender', 'receiver', 'created_at', 'is_read',
+        'is_image', 'image_url', 'sender__username', 'sender__avatar', 'edited_at', 'updated_at',
+    )
+
+    def __init__(self, rows, context=None):
+        self.rows = rows
+        self.context = context or {}
+
+    @property
+    def data(self):
+        format_datetime = datetime_formatter()
+        avatar_url = avatar_url_resolver()
+        with serializing():
+            return [self.row(row, format_datetime, avatar_url) for row in self.rows]
+
+    @staticmethod
+    def row(row, format_datetime, avatar_url):
+        return {
+            'id': row['id'],
+            'content': row['content'],
+            'sender': row['sender'],
+            'receiver': row['receiver'],
+            'created_at': format_datetime(row['created_at']),
+            'is_read': row['is_read'],
+            'is_image': row['is_image'],
+            'image_url': row['image_url'],
+            'sender_name': row['sender__username'],
+            'sender_avatar': avatar_url(row['sender__avatar']) if row['sender__avatar'] else None,
+            'edited_at': format_datetime(row['edited_at']) if row['edited_at'] else None,
+            'updated_at': format_datetime(row['updated_at']),
+        }
+
+
+class ContactRowSerializer:
+    """
+    Fast path for contact lists: builds ContactSerializer's output directly
+    from `.values(*ContactRowSerializer.columns)` rows. Output is identical.
+    """
+    columns = (
+        'id', 'contact_id', 'contact__email', 'contact__username', 'contact__avatar',
+        'last_message_id', 'last_message__content', 'last_message__created_at',
+        'last_message_is_read', 'last_message__is_image', 'last_message__image_url',
+        'contact__userstatus__is_online', 'unread_count', 'created_at',
+    )
+
+    def __init__(self, rows, context=None):
+        self.rows = rows
+        self.context = context or {}
+
+    @property
+    def data(self):
+        format_datetime = datetime_formatter()
+        avatar_url = avatar_url_resolver()
+        request = self.context.get('request')
+        absolute = request.build_absolute_uri if request is not None else (lambda url: url)
+        with serializing():
+            return [self.row(row, format_datetime, avatar_url, absolute) for row in self.rows]
+
+    @staticmethod
+    def row(row, format_datetime, avatar_url, absolute):
+        return {
+            'id': row['id'],
+            'contact_details': {
+                'id': row['contact_id'],
+                'email': row['contact__email'],
+                'username': row['contact__username'],
+                'avatar': absolute(avatar_url(row['contact__avatar'])) if row['contact__avatar'] else None,
+            },
+            'last_message': {
+                'id': row['last_message_id'],
+                'content': row['last_message__content'],
+                'timestamp': row['last_message__created_at'].strftime("%I:%M%p"),
+                'is_read': row['last_message_is_read'],
+                'is_image': row['last_message__is_image'],
+                'image_url': row['last_message__image_url'] if row['last_message__is_image'] else None,
+            } if row['last_message_id'] is not None else None,
+            'online': bool(row['contact__userstatus__is_online']),
+            'unread_count': row['unread_count'],
+            'created_at': format_datetime(row['created_at']),
+        }
@@ -0,0 +1,21 @@
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_save, post_delete
+from django.contrib.auth import get_user_model
+from django.dispatch import receiver
+from . import instrumentation
+from .middleware import user_cache
+
+User = get_user_model()
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_cached_user(sender, instance, **kwargs):
+    """Drop the websocket auth cache entry whenever a user changes."""
+    user_cache.invalidate(instance.pk)
+
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    """Count queries on every new database connection (see messaging.instrumentation)."""
+    instrumentation.install(connection=connection)
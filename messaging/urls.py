@@ -1,7 +1,7 @@
 # messaging/urls.py
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import MessageViewSet, ContactViewSet, UserStatusViewSet
+from .views import MessageViewSet, ContactViewSet, UserStatusViewSet, InstrumentationView
 from .routing import websocket_urlpatterns
 
 router = DefaultRouter()
@@ -10,5 +10,6 @@ router.register(r'messages', MessageViewSet, basename='message')
 router.register(r'status', UserStatusViewSet, basename='status')
 
 urlpatterns = [
+    path('instrumentation/', InstrumentationView.as_view(), name='instrumentation'),
     path('', include(router.urls)),
 ]
\ No newline at end of file
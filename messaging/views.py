@@ -1,15 +1,30 @@
 # messaging/views.py
+import hashlib
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
-from rest_framework.exceptions import PermissionDenied
-from django.db.models import Q, F, Max
+from rest_framework.views import APIView
+from rest_framework.exceptions import PermissionDenied, ValidationError
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.crypto import constant_time_compare
+from django.utils.http import quote_etag
+from django.db import DatabaseError, connection, transaction
+from django.db.models import F, Q
 from django.contrib.auth import get_user_model
-from .models import Message, Contact, UserStatus
+from . import instrumentation, metrics, search
+from .models import Message, Contact, UserStatus, conversation_key_for
+from .pagination import KeysetPagination, SearchPagination, SyncPagination
 from .serializers import (
     MessageSerializer,
+    MessageRowSerializer,
     ContactSerializer,
+    ContactRowSerializer,
     UserStatusSerializer,
     ContactInviteSerializer
 )
@@ -23,6 +38,14 @@ logger = getLogger(__name__)
 class ContactViewSet(viewsets.ModelViewSet):
     serializer_class = ContactSerializer
     permission_classes = [IsAuthenticated]
+    # Maximum SQL queries per action (see messaging.instrumentation)
+    query_budgets = {
+        'list': 2,
+        'inbox': 2,
+        'retrieve': 2,
+        'invite': 6,
+        'mark_read': 4,
+    }
 
     def get_queryset(self):
         user = self.request.user
@@ -30,9 +53,35 @@ class ContactViewSet(viewsets.ModelViewSet):
             raise PermissionDenied("Authentication required")
         return Contact.objects.filter(user=user)\
             .select_related('contact', 'contact__userstatus', 'last_message')\
-            .annotate(
-                last_message_time=Max('last_message__created_at')
-            ).order_by('-last_message_time')
+            .with_read_state()\
+            .order_by(F('last_message__created_at').desc(nulls_last=True), '-id')
+
+    def list(self, request, *args, **kwargs):
+        return self.inbox(request)
+
+    @action(detail=False, methods=['get'])
+    def inbox(self, request):
+        """
+        Every conversation with the peer's profile and presence, a preview of
+        the last message and the unread count, most recent first, from one
+        query. Answers 304 Not Modified while `If-None-Match` still matches.
+        """
+        rows = list(self.get_queryset().values(*ContactRowSerializer.columns))
+        etag = self.inbox_etag(rows)
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = Response(ContactRowSerializer(rows, context=self.get_serializer_context()).data)
+        response['ETag'] = etag
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+    def inbox_etag(self, rows):
+        # The rows hold everything the response shows; avatar URLs also
+        # depend on the host they are built against
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(self.request.build_absolute_uri('/').encode())
+        digest.update(repr(rows).encode())
+        return quote_etag(digest.hexdigest())
 
     @action(detail=False, methods=['post'])
     def invite(self, request):
@@ -66,79 +115,141 @@ class ContactViewSet(viewsets.ModelViewSet):
 
     @action(detail=True, methods=['post'])
     def mark_read(self, request, pk=None):
+        """
+        Mark the conversation read up to `message_id` (default: its last
+        message) and send the contact a read receipt with the new watermark.
+        """
+        up_to = request.data.get('message_id')
+        if up_to is not None:
+            try:
+                up_to = int(up_to)
+            except (TypeError, ValueError):
+                raise ValidationError({'message_id': 'A valid integer is required.'})
         try:
             contact = self.get_object()
-            Message.objects.filter(
-                sender=contact.contact,
-                receiver=request.user,
-                is_read=False
-            ).update(is_read=True)
-            return Response(status=status.HTTP_204_NO_CONTENT)
+            watermark = Contact.mark_conversation_read(request.user.id, contact.contact_id, up_to)
         except Contact.DoesNotExist:
             return Response(status=status.HTTP_404_NOT_FOUND)
+        if watermark is not None:
+            async_to_sync(get_channel_layer().group_send)(f"user_{contact.contact_id}", {
+                'type': 'messages_read',
+                'reader_id': request.user.id,
+                'last_read_message_id': watermark,
+            })
+        return Response(status=status.HTTP_204_NO_CONTENT)
 
 class MessageViewSet(viewsets.ModelViewSet):
     serializer_class = MessageSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
+    query_budgets = {
+        'list': 3,
+        'create': 6,
+        'search': 3,
+        'sync': 3,
+    }
 
     def get_queryset(self):
         contact_id = self.request.query_params.get('contact')
-        
-        print(f"📌 DEBUG: Extracted contact_id: {contact_id}")
+        messages = Message.objects.with_read_state()
 
         if not contact_id:
-            print("❌ No contact_id provided, returning empty queryset.")
-            return Message.objects.none()  # Return empty queryset
+            logger.debug("No contact_id provided, returning empty queryset")
+            return messages.none()  # Return empty queryset
 
         try:
             contact = Contact.objects.get(
                 user=self.request.user,
                 contact_id=contact_id
             )
-            print(f"✅ Found contact: {contact}")
         except Contact.DoesNotExist:
-            print(f"❌ Contact not found for user {self.request.user.id} and contact_id {contact_id}")
-            return Message.objects.none()
+            logger.debug("Contact %s not found for user %s", contact_id, self.request.user.id)
+            return messages.none()
 
         # Fetch messages between sender and receiver
-        queryset = Message.objects.filter(
-            Q(sender=self.request.user, receiver_id=contact_id) |
-            Q(sender_id=contact_id, receiver=self.request.user)
-        ).select_related('sender').order_by('created_at')
+        return messages.filter(
+            conversation_key=conversation_key_for(self.request.user.id, contact.contact_id)
+        ).select_related('sender').order_by('created_at', 'id')
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.get_queryset()
+        logger.debug("Listing messages for user %s with %s", request.user.id, request.query_params)
 
-        print(f"✅ Found {queryset.count()} messages for conversation with {contact_id}")
+        page = self.paginate_queryset(queryset.values(*MessageRowSerializer.columns))
+        serializer = MessageRowSerializer(page, context=self.get_serializer_context())
+        return self.get_paginated_response(serializer.data)
 
-        return queryset
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        """
+        Full-text search over the caller's conversations, or only the one with
+        `contact`, best match first. End `q` with `*` to match the last word
+        as a prefix (see messaging.search).
+        """
+        terms, prefix = search.parse_query(request.query_params.get('q', ''))
+        if not terms:
+            raise ValidationError({'q': 'Enter at least one word to search for.'})
+        contact_id = request.query_params.get('contact')
+        if contact_id is not None:
+            try:
+                contact_id = int(contact_id)
+            except ValueError:
+                raise ValidationError({'contact': 'A valid integer is required.'})
 
+        paginator = SearchPagination()
+        limit, offset = paginator.get_window(request)
+        ids = paginator.paginate_ids(
+            search.search_message_ids(request.user.id, terms, contact_id, limit + 1, offset, prefix)
+        )
+        rows = {}
+        if ids:
+            found = Message.objects.filter(id__in=ids).with_read_state().order_by()
+            rows = {row['id']: row for row in found.values(*MessageRowSerializer.columns)}
+        page = [rows[pk] for pk in ids if pk in rows]
+        serializer = MessageRowSerializer(page, context=self.get_serializer_context())
+        return paginator.get_paginated_response(serializer.data)
 
-    def list(self, request, *args, **kwargs):
-        queryset = self.get_queryset()
-        
-        # Add debug information
-        print(f"Request user: {request.user.id}")
-        print(f"Query params: {request.query_params}")
-        print(f"Message count: {queryset.count()}")
-        
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+    @action(detail=False, methods=['get'])
+    def sync(self, request):
+        """
+        Changes in every conversation of the caller since the `since` cursor:
+        new and edited messages, oldest change first (see SyncPagination),
+        and the read watermarks of both sides that moved.
+        """
+        queryset = Message.objects.filter(Q(sender=request.user) | Q(receiver=request.user)).with_read_state()
+        paginator = SyncPagination()
+        page = paginator.paginate_queryset(queryset.values(*MessageRowSerializer.columns), request, view=self)
+        serializer = MessageRowSerializer(page, context=self.get_serializer_context())
+
+        read = Contact.objects.filter(Q(user=request.user) | Q(contact=request.user), read_at__isnull=False)
+        if paginator.changed_since is not None:
+            read = read.filter(read_at__gte=paginator.changed_since)
+        read = [
+            {'reader_id': reader_id, 'contact_id': contact_id, 'last_read_message_id': watermark}
+            for reader_id, contact_id, watermark
+            in read.values_list('user_id', 'contact_id', 'last_read_message_id')
+        ]
+        return paginator.get_paginated_response(serializer.data, read)
 
     def perform_create(self, serializer):
-        message = serializer.save(sender=self.request.user)
-        print(f"Created message: {message.id} from {message.sender} to {message.receiver}")  # Debug log
-        
-        # Update last message for both contacts
-        contacts_updated = Contact.objects.filter(
-            Q(user=self.request.user, contact=message.receiver) |
-            Q(user=message.receiver, contact=self.request.user)
-        ).update(last_message=message)
-        
-        print(f"Updated {contacts_updated} contacts with new last message")  # Debug log
-        
+        with transaction.atomic():
+            message = serializer.save(sender=self.request.user)
+
+            # Update last message and unread counter for both contacts
+            contacts_updated = Contact.record_message(message)
+
+        logger.debug(
+            "Created message %s from %s to %s, updated %s contacts",
+            message.id, message.sender_id, message.receiver_id, contacts_updated
+        )
         return message
 
 class UserStatusViewSet(viewsets.GenericViewSet):
     permission_classes = [IsAuthenticated]
     serializer_class = UserStatusSerializer 
+    query_budgets = {
+        'toggle': 3,
+    }
 
     @action(detail=False, methods=['post'])
     def toggle(self, request):
@@ -151,4 +262,69 @@ class UserStatusViewSet(viewsets.GenericViewSet):
             status.save()
         
         serializer = self.get_serializer(status) 
-        return Response(serializer.data)
\ No newline at end of file
+        return Response(serializer.data)
+
+
+class InstrumentationView(APIView):
+    """Per-endpoint query counts and timings of this process. Staff only, unless DEBUG is on."""
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        if not (settings.DEBUG or request.user.is_staff):
+            raise PermissionDenied("Staff only")
+        return Response(instrumentation.stats.snapshot())
+
+
+def has_metrics_access(request):
+    """
+    Whether `request` may see operational details: it carries
+    `Authorization: Bearer <METRICS_TOKEN>`, comes from a logged-in staff
+    user, or DEBUG is on. Without a METRICS_TOKEN nobody else may.
+    """
+    token = settings.METRICS_TOKEN
+    if token and constant_time_compare(request.headers.get('Authorization', ''), f"Bearer {token}"):
+        return True
+    user = getattr(request, 'user', None)
+    return settings.DEBUG or bool(user and user.is_staff)
+
+
+def metrics_view(request):
+    """Prometheus scrape endpoint; see has_metrics_access() for who may read it."""
+    if not has_metrics_access(request):
+        return HttpResponse(status=401)
+    return HttpResponse(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+
+def health_view(request):
+    """
+    Load balancer health check: 200 when the database answers, else 503.
+    Callers with metrics access (see has_metrics_access) also get how busy
+    the connection pool and the consumers' database threads are.
+    """
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        healthy = True
+    except DatabaseError:
+        logger.exception("Health check: database unavailable")
+        healthy = False
+
+    body = {'status': 'ok' if healthy else 'unavailable'}
+    if has_metrics_access(request):
+        database = {'vendor': connection.vendor}
+        pool = getattr(connection, 'pool', None)
+        if pool is not None:
+            stats = pool.get_stats()
+            database['pool'] = {
+                'size': stats['pool_size'],
+                'max_size': stats['pool_max'],
+                'in_use': stats['pool_size'] - stats['pool_available'],
+                'waiting': stats.get('requests_waiting', 0),
+            }
+        body['database'] = database
+        body['db_executor'] = {
+            'workers': settings.CHAT_DB_EXECUTOR_WORKERS or 1,
+            'running': int(metrics.db_calls_running.get()),
+            'queued': int(metrics.db_calls_queued.get()),
+        }
+    return JsonResponse(body, status=200 if healthy else 503)
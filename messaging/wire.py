@@ -0,0 +1,60 @@
+# messaging/wire.py
+"""
+Websocket frame encodings, chosen per connection through the websocket
+subprotocol the client asks for.
+
+- `chat.json`, also used when the client asks for none of ours: JSON in
+  text frames.
+- `chat.msgpack`, when msgpack is installed: MessagePack in binary frames.
+
+Both carry the same maps, so a client handles every frame type once,
+whatever the encoding. Inbound frames are decoded by their kind: a text
+frame is JSON and a binary frame is MessagePack.
+"""
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JSONCodec:
+    subprotocol = 'chat.json'
+    binary = False
+
+    @staticmethod
+    def encode(payload):
+        # ASCII only, so len() of the frame is its size in bytes
+        return json.dumps(payload)
+
+
+class MessagePackCodec:
+    subprotocol = 'chat.msgpack'
+    binary = True
+
+    @staticmethod
+    def encode(payload):
+        return msgpack.packb(payload)
+
+
+CODECS = {codec.subprotocol: codec for codec in (JSONCodec, MessagePackCodec) if not codec.binary or msgpack}
+
+
+def negotiate(subprotocols):
+    """
+    (codec, subprotocol to accept) for the subprotocols a client offered:
+    the first of them we support, else JSON without a subprotocol.
+    """
+    for name in subprotocols:
+        if name in CODECS:
+            return CODECS[name], name
+    return JSONCodec, None
+
+
+def decode(text_data=None, bytes_data=None):
+    if text_data is not None:
+        return json.loads(text_data)
+    if msgpack is None:
+        raise ValueError("Binary frames need msgpack")
+    return msgpack.unpackb(bytes_data)